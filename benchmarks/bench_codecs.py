@@ -0,0 +1,57 @@
+"""Encode and decode speed and size of the installed codecs.
+
+    python -m benchmarks.bench_codecs [ROUNDS]
+"""
+import sys
+import time
+
+import codec
+
+PAYLOADS = {
+    "small": {"type": "chat", "user": "alice", "text": "hello there"},
+    "ticker": [{"symbol": "SYM%d" % idx, "price": 100.25 + idx,
+                "volume": idx * 1000, "change": -0.5 * idx}
+               for idx in range(50)],
+    "nested": {"id": 42, "tags": ["a", "b", "c"] * 10,
+               "items": [{"id": idx, "name": "item %d" % idx,
+                          "attrs": {"size": idx, "flag": idx % 2 == 0}}
+                         for idx in range(200)]},
+}
+
+
+def codecs():
+    found = []
+    for backend, module in (("orjson", codec.orjson),
+                            ("ujson", codec.ujson),
+                            ("json", codec.json)):
+        if module is not None:
+            found.append(("json/" + backend, codec.JsonCodec(backend)))
+    if codec.msgpack is not None:
+        found.append(("msgpack", codec.MsgpackCodec()))
+    return found
+
+
+def timeit(fn, arg, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn(arg)
+    return (time.perf_counter() - started) / rounds
+
+
+def main(argv):
+    rounds = int(argv[0]) if argv else 2000
+
+    print("%8s %14s %12s %12s %10s" % (
+        "payload", "codec", "encode, us", "decode, us", "size, B"))
+    for name, payload in PAYLOADS.items():
+        for codec_name, instance in codecs():
+            data = instance.encode(payload)
+            print("%8s %14s %12.2f %12.2f %10d" % (
+                name, codec_name,
+                timeit(instance.encode, payload, rounds) * 1e6,
+                timeit(instance.decode, data, rounds) * 1e6,
+                len(data.encode("utf-8") if isinstance(data, str) else data)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
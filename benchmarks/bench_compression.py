@@ -0,0 +1,67 @@
+"""CPU and bytes on the wire for compressed and uncompressed fan-out.
+
+One broadcast message is framed for every session: uncompressed,
+deflated per connection, and deflated once and shared.
+
+    python -m benchmarks.bench_compression [SESSIONS] [SIZES...]
+"""
+import json
+import sys
+import time
+import zlib
+
+from compression import build_frame, deflate, deflated_frame
+from protocol import encode_text
+
+
+def payload(size):
+    items = []
+    text = "[]"
+    idx = 0
+    while len(text) < size:
+        items.append({"symbol": "SYM%d" % (idx % 50), "price": 100 + idx % 7,
+                      "volume": idx * 13 % 1000, "side": "buy"})
+        text = json.dumps(items)
+        idx += 1
+    return text[:size]
+
+
+def plain(message, sessions):
+    return [build_frame(message) for _ in range(sessions)]
+
+
+def per_connection(message, sessions):
+    return [build_frame(deflate(message), compressed=True)
+            for _ in range(sessions)]
+
+
+def shared(message, sessions):
+    return [deflated_frame(message, zlib.MAX_WBITS) for _ in range(sessions)]
+
+
+def bench(fanout, size, sessions):
+    message = encode_text(payload(size))
+
+    started = time.process_time()
+    frames = fanout(message, sessions)
+    elapsed = time.process_time() - started
+
+    return elapsed, sum(len(frame) for frame in frames)
+
+
+def main(argv):
+    sessions = int(argv[0]) if argv else 10000
+    sizes = [int(arg) for arg in argv[1:]] or [64, 1024, 16384, 131072]
+
+    print("%8s %16s %12s %14s" % ("size", "mode", "cpu, ms", "wire, KiB"))
+    for size in sizes:
+        for name, fanout in (("plain", plain),
+                             ("per-connection", per_connection),
+                             ("shared", shared)):
+            elapsed, wire = bench(fanout, size, sessions)
+            print("%8d %16s %12.1f %14.0f" % (
+                size, name, elapsed * 1000, wire / 1024))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,135 @@
+"""Messages per second per core through the WebSocket send loop.
+
+Every connection gets its messages queued in bursts, raw socket clients
+read and discard the frames. Runs once with corked writes, all frames of a
+wakeup written at once, and once with a write per frame. The clients run
+in the same process and cost the same in both runs.
+
+    python -m benchmarks.bench_cork [CONNECTIONS] [MESSAGES] [BURST]
+"""
+import asyncio
+import base64
+import gc
+import os
+import sys
+import time
+import uuid
+
+from aiohttp import web
+
+from session_manager import SessionManager
+from transport import WebSocketTransport_HLEB
+
+SIZE = 64
+MESSAGE = "x" * SIZE
+FRAME_SIZE = 2 + SIZE
+
+
+async def handler(msg, session):
+    pass
+
+
+async def produce(session, count, burst):
+    for idx in range(0, count, burst):
+        for _ in range(min(burst, count - idx)):
+            session.send(MESSAGE)
+        await asyncio.sleep(0)
+
+    # the send loop drains the queue, then stops
+    await session._remote_closed()
+
+
+async def websocket(request):
+    app = request.app
+    manager = app["manager"]
+
+    ws = web.WebSocketResponse(autoping=False)
+    await ws.prepare(request)
+
+    session = manager.get(str(uuid.uuid4()), True)
+    await manager.acquire(session)
+    session._pop_messages()
+
+    # drive the send loop alone, the receive side is idle here
+    transport = WebSocketTransport_HLEB(
+        session, manager.loop, cork=app["cork"])
+    producer = asyncio.ensure_future(
+        produce(session, app["messages"], app["burst"]))
+    await transport.server(ws)
+    await producer
+    await manager.release(session)
+    return ws
+
+
+async def client(port, expected):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((
+        "GET /ws HTTP/1.1\r\n"
+        "Host: 127.0.0.1:%d\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        "Sec-WebSocket-Key: %s\r\n"
+        "Sec-WebSocket-Version: 13\r\n\r\n" % (port, key)).encode())
+
+    await reader.readuntil(b"\r\n\r\n")
+    received = 0
+    while received < expected:
+        data = await reader.read(1 << 16)
+        if not data:
+            raise RuntimeError("Connection closed early")
+        received += len(data)
+
+    writer.close()
+
+
+async def bench(loop, cork, connections, messages, burst):
+    app = web.Application()
+    app["manager"] = manager = SessionManager(
+        app, handler, loop, timeout=3600)
+    app["cork"] = cork
+    app["messages"] = messages
+    app["burst"] = burst
+    app.router.add_get("/ws", websocket)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    gc.collect()
+    started = time.perf_counter()
+    cpu = time.process_time()
+    await asyncio.gather(*(
+        client(port, messages * FRAME_SIZE) for _ in range(connections)))
+    cpu = time.process_time() - cpu
+    elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+    await manager.clear()
+    return elapsed, cpu
+
+
+def main(argv):
+    connections = int(argv[0]) if len(argv) > 0 else 100
+    messages = int(argv[1]) if len(argv) > 1 else 5000
+    burst = int(argv[2]) if len(argv) > 2 else 100
+    total = connections * messages
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        print("%8s %10s %12s %14s %16s" % (
+            "mode", "messages", "elapsed, s", "messages/s", "messages/cpu-s"))
+        for name, cork in (("per-frame", False), ("corked", True)):
+            elapsed, cpu = loop.run_until_complete(
+                bench(loop, cork, connections, messages, burst))
+            print("%8s %10d %12.2f %14.0f %16.0f" % (
+                name, total, elapsed, total / elapsed, total / cpu))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,86 @@
+"""Expiry sweep cost as the number of live sessions grows.
+
+Only a fixed number of sessions is due on every sweep, so the sweep time
+should stay flat while the pool grows. The "ticked" column sweeps a pool
+where every live session was active since it was scheduled: its deadline
+moved past the sweep, which should not cost the sweep anything either.
+"tick" is the cost of ``Session._tick`` moving a session in the wheel.
+
+    python -m benchmarks.bench_expiry [DUE] [SIZES...]
+"""
+import asyncio
+import sys
+import time
+from datetime import timedelta
+
+from session_manager import SessionManager
+
+TICKED_TIMEOUT = 3600
+
+
+async def handler(msg, session):
+    pass
+
+
+def populate(manager, size, due, ticked=False):
+    manager.timeout = timedelta(seconds=-1)
+    for idx in range(due):
+        manager.get("due%d" % idx, True)
+
+    if ticked:
+        # scheduled as due, then active since
+        for idx in range(size - due):
+            manager.get("idle%d" % idx, True)._tick(TICKED_TIMEOUT)
+    else:
+        manager.timeout = timedelta(hours=1)
+        for idx in range(size - due):
+            manager.get("idle%d" % idx, True)
+
+
+def bench(loop, size, due, ticked=False):
+    manager = SessionManager(None, handler, loop)
+    populate(manager, size, due, ticked)
+
+    started = time.perf_counter()
+    loop.run_until_complete(manager._expire(loop.time()))
+    elapsed = time.perf_counter() - started
+
+    assert len(manager) == size - due
+    loop.run_until_complete(manager.clear())
+    return elapsed
+
+
+def bench_tick(loop, size):
+    """Seconds per ``_tick`` of a session in a pool of that size."""
+    manager = SessionManager(None, handler, loop, timeout=TICKED_TIMEOUT)
+    sessions = [manager.get("s%d" % idx, True) for idx in range(size)]
+
+    started = time.perf_counter()
+    for session in sessions:
+        session._tick()
+    elapsed = time.perf_counter() - started
+
+    loop.run_until_complete(manager.clear())
+    return elapsed / size
+
+
+def main(argv):
+    due = int(argv[0]) if argv else 100
+    sizes = [int(arg) for arg in argv[1:]] or [1000, 10000, 100000]
+
+    loop = asyncio.new_event_loop()
+    try:
+        print("%10s %8s %12s %12s %10s" % (
+            "sessions", "due", "sweep, ms", "ticked, ms", "tick, ns"))
+        for size in sizes:
+            elapsed = bench(loop, size, due)
+            ticked = bench(loop, size, due, True)
+            tick = bench_tick(loop, size)
+            print("%10d %8d %12.3f %12.3f %10.0f" % (
+                size, due, elapsed * 1000, ticked * 1000, tick * 1e9))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,87 @@
+"""Event loop lag caused by heartbeats.
+
+Runs the heartbeat timer of a manager holding many acquired sessions for a
+few intervals and samples how late the loop wakes up from short sleeps,
+once with every session pinged in one pass and once with pings spread
+over the interval. Pings are taken off the queues as soon as they are
+queued, the way transports would, so every heartbeat queues a new one.
+
+    python -m benchmarks.bench_heartbeat [SESSIONS] [SLICES]
+"""
+import asyncio
+import gc
+import sys
+
+from session import Session
+from session_manager import SessionManager
+
+HEARTBEAT = 0.5
+CYCLES = 4
+SAMPLE = 0.002
+
+
+async def handler(msg, session):
+    pass
+
+
+class PingedSession(Session):
+    """Session whose pings are sent right away."""
+
+    __slots__ = ()
+
+    def _heartbeat(self):
+        super(PingedSession, self)._heartbeat()
+        while self._pending():
+            self._take()
+
+
+async def sample_lag(loop, duration):
+    samples = []
+    deadline = loop.time() + duration
+    while loop.time() < deadline:
+        started = loop.time()
+        await asyncio.sleep(SAMPLE)
+        samples.append(loop.time() - started - SAMPLE)
+    return sorted(samples)
+
+
+def bench(loop, sessions, slices):
+    manager = SessionManager(
+        None, handler, loop, heartbeat=HEARTBEAT, timeout=3600,
+        heartbeat_slices=slices)
+    manager.factory = PingedSession
+    for idx in range(sessions):
+        session = manager.get("s%d" % idx, True)
+        loop.run_until_complete(manager.acquire(session))
+        while session._pending():
+            session._take()  # the open frame
+
+    gc.collect()
+    manager.start()
+    samples = loop.run_until_complete(
+        sample_lag(loop, HEARTBEAT * CYCLES))
+    manager.stop()
+    loop.run_until_complete(manager.clear())
+
+    last = len(samples) - 1
+    return samples[int(last * 0.5)], samples[int(last * 0.99)], samples[last]
+
+
+def main(argv):
+    sessions = int(argv[0]) if len(argv) > 0 else 100000
+    slices = int(argv[1]) if len(argv) > 1 else 50
+
+    loop = asyncio.new_event_loop()
+    try:
+        print("%8s %10s %10s %10s %10s" % (
+            "slices", "sessions", "p50, ms", "p99, ms", "max, ms"))
+        for count in (1, slices):
+            p50, p99, worst = bench(loop, sessions, count)
+            print("%8d %10d %10.2f %10.2f %10.2f" % (
+                count, sessions, p50 * 1000, p99 * 1000, worst * 1000))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+"""Presence counts and join announcements as a room fills up.
+
+Sessions are spread over rooms and acquired without transports. Compares
+counting the connected members of a room with ``Presence`` to scanning
+``active_sessions()``, then fills one room with sessions announcing every
+change to its members, once on each join and once with batched changes.
+Reports lookups per second, and messages queued and time taken to fill
+the room.
+
+    python -m benchmarks.bench_presence [SESSIONS] [ROOMS] [ROOM_SIZE]
+"""
+import asyncio
+import sys
+import time
+
+from presence import Presence
+from session_manager import SessionManager
+
+BATCH = 0.05
+LOOKUPS = 1000
+
+
+async def handler(msg, session):
+    pass
+
+
+async def populate(manager, sessions, rooms):
+    for idx in range(sessions):
+        session = manager.get("s%d" % idx, True)
+        await manager.acquire(session, heartbeat=False)
+        manager.subscribe(session, "room%d" % (idx % rooms))
+
+
+def scan(manager, room):
+    return sum(1 for session in manager.active_sessions()
+               if session.acquired and session.topics and
+               room in session.topics)
+
+
+async def counts(loop, sessions, rooms):
+    manager = SessionManager(
+        None, handler, loop, timeout=3600, presence=Presence())
+    await populate(manager, sessions, rooms)
+    assert manager.presence.connected("room0") == scan(manager, "room0")
+
+    results = []
+    for name, fn in (("scan", scan),
+                     ("presence", lambda m, r: m.presence.connected(r))):
+        started = time.perf_counter()
+        for idx in range(LOOKUPS):
+            fn(manager, "room%d" % (idx % rooms))
+        results.append((name, LOOKUPS / (time.perf_counter() - started)))
+
+    await manager.clear()
+    return results
+
+
+async def fill(loop, size, batch):
+    presence = Presence(batch=batch)
+    manager = SessionManager(
+        None, handler, loop, timeout=3600, presence=presence)
+
+    def changed(room, joined, left):
+        manager.publish(room, "%d online" % presence.connected(room))
+    presence.subscribe(changed)
+
+    started = time.perf_counter()
+    for idx in range(size):
+        session = manager.get("s%d" % idx, True)
+        await manager.acquire(session, heartbeat=False)
+        manager.subscribe(session, "room")
+        if idx % 100 == 0:
+            await asyncio.sleep(0)  # sessions keep arriving
+    presence.flush()
+    elapsed = time.perf_counter() - started
+
+    messages = manager.budget.messages
+    await manager.clear()
+    return messages, elapsed
+
+
+def main(argv):
+    sessions = int(argv[0]) if len(argv) > 0 else 10000
+    rooms = int(argv[1]) if len(argv) > 1 else 100
+    size = int(argv[2]) if len(argv) > 2 else 2000
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        print("connected count, %d sessions in %d rooms:" % (sessions, rooms))
+        for name, rate in loop.run_until_complete(
+                counts(loop, sessions, rooms)):
+            print("  %-9s %12.0f lookups/s" % (name, rate))
+
+        print("filling a room with %d sessions:" % size)
+        for name, batch in (("each", 0), ("batched", BATCH)):
+            messages, elapsed = loop.run_until_complete(
+                fill(loop, size, batch))
+            print("  %-9s %12d messages %8.3f s" % (name, messages, elapsed))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
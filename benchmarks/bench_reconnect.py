@@ -0,0 +1,152 @@
+"""Recovery time and throughput of pooled clients under forced disconnects.
+
+A local echo server answers a ``ClientPool``. Messages are sent through
+the pool and counted when they come back, first on steady connections,
+then while the server aborts every connection at an interval. Reports
+echoes per second for both runs, how long the clients took to reconnect
+and how many messages went missing with the dropped connections.
+
+    python -m benchmarks.bench_reconnect [CONNECTIONS] [MESSAGES] [DROPS]
+"""
+import asyncio
+import sys
+import time
+
+from aiohttp import web
+
+from client_pool import Backoff, ClientPool
+from protocol import MSG_MESSAGE
+
+BURST = 100
+DROP_INTERVAL = 0.5
+
+
+class Echoes(object):
+
+    def __init__(self):
+        self.count = 0
+        self.waiter = None
+        self.expected = 0
+
+    async def handler(self, msg, session):
+        if msg.type == MSG_MESSAGE:
+            self.count += 1
+            if (self.waiter is not None and not self.waiter.done() and
+                    self.count >= self.expected):
+                self.waiter.set_result(None)
+
+    async def wait(self, expected, timeout):
+        self.expected = expected
+        if self.count >= expected:
+            return True
+
+        self.waiter = asyncio.Future()
+        try:
+            await asyncio.wait_for(self.waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+async def start_server(connections):
+    async def echo(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        connections.add(request.transport)
+        try:
+            async for msg in ws:
+                if msg.type == web.WSMsgType.TEXT:
+                    await ws.send_str(msg.data)
+        finally:
+            connections.discard(request.transport)
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/ws", echo)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, "http://127.0.0.1:%d/ws" % port
+
+
+async def send(pool, url, count):
+    for idx in range(0, count, BURST):
+        for _ in range(min(BURST, count - idx)):
+            pool.send(url, "ping")
+        await asyncio.sleep(0)
+
+
+async def steady(pool, url, echoes, messages):
+    started = time.perf_counter()
+    await send(pool, url, messages)
+    await echoes.wait(messages, 60)
+    return time.perf_counter() - started
+
+
+async def drops(pool, url, echoes, messages, count, connections):
+    loop = asyncio.get_event_loop()
+    clients = pool.get(url)
+    recoveries = []
+
+    sender = asyncio.ensure_future(send(pool, url, messages))
+    started = time.perf_counter()
+    for _ in range(count):
+        await asyncio.sleep(DROP_INTERVAL)
+        for transport in list(connections):
+            transport.abort()
+
+        dropped = loop.time()
+        await asyncio.sleep(0.01)  # let the clients notice
+        await asyncio.gather(*(
+            client.wait_connected(30) for client in clients))
+        recoveries.append(loop.time() - dropped)
+
+    await sender
+    # echoes of messages lost with the connections never come back
+    await echoes.wait(messages, 5)
+    return time.perf_counter() - started, sorted(recoveries)
+
+
+async def run(connections, messages, count):
+    server_connections = set()
+    runner, url = await start_server(server_connections)
+
+    echoes = Echoes()
+    pool = ClientPool(
+        echoes.handler, size=connections, backoff=Backoff(0.05, 1.0))
+    await pool.warm(url, 10)
+
+    elapsed = await steady(pool, url, echoes, messages)
+    print("steady:    %8.0f echoes/s" % (messages / elapsed))
+
+    echoes.count = 0
+    elapsed, recoveries = await drops(
+        pool, url, echoes, messages, count, server_connections)
+    print("dropping:  %8.0f echoes/s, %d drops" % (
+        echoes.count / elapsed, count))
+    print("recovery:  p50 %.1f ms, max %.1f ms" % (
+        recoveries[len(recoveries) // 2] * 1000, recoveries[-1] * 1000))
+    print("lost:      %d of %d messages" % (
+        messages - echoes.count, messages))
+
+    await pool.close()
+    await runner.cleanup()
+
+
+def main(argv):
+    connections = int(argv[0]) if len(argv) > 0 else 10
+    messages = int(argv[1]) if len(argv) > 1 else 200000
+    count = int(argv[2]) if len(argv) > 2 else 5
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run(connections, messages, count))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
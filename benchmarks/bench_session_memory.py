@@ -0,0 +1,53 @@
+"""Memory held by idle sessions.
+
+Counts everything allocated while creating sessions through a manager:
+the session itself, its pool entry and its expiry wheel entry.
+
+    python -m benchmarks.bench_session_memory [SIZES...]
+"""
+import asyncio
+import gc
+import sys
+import tracemalloc
+
+from session_manager import SessionManager
+
+
+async def handler(msg, session):
+    pass
+
+
+def bench(loop, size):
+    manager = SessionManager(None, handler, loop)
+    ids = ["%032x" % idx for idx in range(size)]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for id in ids:
+        manager.get(id, True)
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    loop.run_until_complete(manager.clear())
+    return used
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [10000, 100000, 1000000]
+
+    loop = asyncio.new_event_loop()
+    try:
+        print("%10s %12s %16s" % ("sessions", "total, MiB", "bytes/session"))
+        for size in sizes:
+            used = bench(loop, size)
+            print("%10d %12.1f %16.0f" % (size, used / 2 ** 20, used / size))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,102 @@
+"""Broadcast fan-out with one worker against N sharded workers.
+
+The same number of sessions is split across the workers, worker 0
+broadcasts and every worker fans the messages out to its own sessions.
+
+    python -m benchmarks.bench_sharding [SESSIONS] [MESSAGES] [WORKERS]
+"""
+import asyncio
+import multiprocessing
+import sys
+import tempfile
+import time
+
+from sharding import ShardedSessionManager
+
+DONE = "__done__"
+
+
+async def handler(msg, session):
+    pass
+
+
+class Manager(ShardedSessionManager):
+
+    def __init__(self, *args, **kwargs):
+        super(Manager, self).__init__(*args, **kwargs)
+        self.done = asyncio.Future(loop=self.loop)
+
+    def _bus_message(self, message):
+        super(Manager, self)._bus_message(message)
+        if message[1] == DONE:
+            self.done.set_result(time.monotonic())
+
+
+def worker(shard, shards, path, sessions, messages, ready, results):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    manager = Manager(
+        None, handler, loop, shard, shards, path, max_queue=1)
+    for idx in range(sessions):
+        loop.run_until_complete(
+            manager.acquire(manager.get(manager.new_id(), True)))
+    loop.run_until_complete(manager.start_bus())
+
+    ready.wait()
+
+    if shard == 0:
+        started = time.monotonic()
+        for idx in range(messages):
+            manager.broadcast("message %d" % idx)
+        manager.broadcast(DONE)
+        loop.run_until_complete(manager.bus.drain())
+        results.put((started, time.monotonic()))
+    else:
+        results.put((None, loop.run_until_complete(manager.done)))
+
+    # wait for the others before closing the bus
+    ready.wait()
+    loop.run_until_complete(manager.stop_bus())
+    loop.run_until_complete(manager.clear())
+    loop.close()
+
+
+def bench(workers, sessions, messages):
+    path = tempfile.mkdtemp(prefix="sockjs-bus-")
+    ready = multiprocessing.Barrier(workers)
+    results = multiprocessing.Queue()
+
+    processes = [
+        multiprocessing.Process(
+            target=worker,
+            args=(shard, workers, path, sessions // workers, messages,
+                  ready, results))
+        for shard in range(workers)]
+    for process in processes:
+        process.start()
+
+    times = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    started = min(start for start, _ in times if start is not None)
+    return max(end for _, end in times) - started
+
+
+def main(argv):
+    sessions = int(argv[0]) if len(argv) > 0 else 40000
+    messages = int(argv[1]) if len(argv) > 1 else 100
+    workers = int(argv[2]) if len(argv) > 2 else multiprocessing.cpu_count()
+
+    print("%8s %10s %10s %10s %14s" % (
+        "workers", "sessions", "messages", "time, s", "deliveries/s"))
+    for count in sorted({1, workers}):
+        elapsed = bench(count, sessions, messages)
+        print("%8d %10d %10d %10.3f %14.0f" % (
+            count, sessions, messages, elapsed,
+            sessions * (messages + 1) / elapsed))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
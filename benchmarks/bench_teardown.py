@@ -0,0 +1,50 @@
+"""Time to clear a manager whose close handlers do I/O.
+
+Every closed handler sleeps to stand in for I/O, the pool is cleared with
+several teardown concurrency limits.
+
+    python -m benchmarks.bench_teardown [SESSIONS] [IO_SECONDS] [LIMITS...]
+"""
+import asyncio
+import sys
+
+from protocol import MSG_CLOSED
+from session_manager import SessionManager
+
+
+def make_handler(delay):
+    async def handler(msg, session):
+        if msg.type == MSG_CLOSED:
+            await asyncio.sleep(delay)
+    return handler
+
+
+def bench(loop, sessions, delay, concurrency):
+    manager = SessionManager(
+        None, make_handler(delay), loop, teardown_concurrency=concurrency)
+    for idx in range(sessions):
+        session = manager.get("s%d" % idx, True)
+        loop.run_until_complete(manager.acquire(session))
+
+    return loop.run_until_complete(manager.clear())
+
+
+def main(argv):
+    sessions = int(argv[0]) if len(argv) > 0 else 100000
+    delay = float(argv[1]) if len(argv) > 1 else 0.01
+    limits = [int(arg) for arg in argv[2:]] or [100, 1000, 10000]
+
+    loop = asyncio.new_event_loop()
+    try:
+        print("%12s %10s %10s %10s" % (
+            "concurrency", "sessions", "closed", "time, s"))
+        for concurrency in limits:
+            result = bench(loop, sessions, delay, concurrency)
+            print("%12d %10d %10d %10.2f" % (
+                concurrency, sessions, result.closed, result.elapsed))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
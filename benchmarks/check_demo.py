@@ -0,0 +1,76 @@
+"""Smoke check of the chat demo in ``server.py``.
+
+Runs the demo application in process the way ``run_app`` does, startup
+handlers included, and connects chat clients. Each one must get the
+presence announcement sent when its session opens and joins the room, and
+the chat messages of the others. Exits non-zero on the first failure.
+
+    python -m benchmarks.check_demo [CLIENTS]
+"""
+import asyncio
+import sys
+
+import aiohttp
+from aiohttp import web
+
+import server
+
+TIMEOUT = 5.0
+
+
+async def receive_until(ws, predicate):
+    while True:
+        msg = await asyncio.wait_for(ws.receive(), TIMEOUT)
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            raise AssertionError("Connection closed: %r" % (msg,))
+        if predicate(msg.data):
+            return msg.data
+
+
+async def check(clients):
+    app = server.make_app(handoff=None)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = "http://127.0.0.1:%d/ws" % site._server.sockets[0].getsockname()[1]
+
+    try:
+        async with aiohttp.ClientSession() as client_session:
+            connections = []
+            for _ in range(clients):
+                ws = await client_session.ws_connect(url)
+                connections.append(ws)
+
+            # open handler: joined the room, announced in a batch
+            for ws in connections:
+                text = await receive_until(ws, lambda data: "online" in data)
+                print("announced: %s" % text)
+
+            await connections[0].send_str("hello")
+            for ws in connections:
+                await receive_until(ws, lambda data: data == "hello")
+            print("chat: delivered to %d clients" % clients)
+
+            manager = app["manager"]
+            assert manager.presence.connected(server.CHAT) == clients
+            for ws in connections:
+                await ws.close()
+    finally:
+        await runner.cleanup()
+
+
+def main(argv):
+    clients = int(argv[0]) if argv else 3
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(check(clients))
+    finally:
+        loop.close()
+    print("ok")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
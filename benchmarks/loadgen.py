@@ -0,0 +1,422 @@
+"""Load generator for the SessionManager backed server.
+
+Starts the server in a child process and drives it with many concurrent
+``ws_connect`` clients through scripted scenarios:
+
+``broadcast``: server broadcasts timestamped messages to every client
+``echo``: every client sends timestamped messages and waits for the echo
+``churn``: clients connect and disconnect in a loop
+``expiry``: all clients drop at once, time until the server expired them
+``slow``: some clients stop reading while the others receive broadcasts
+
+Each scenario reports throughput, latency percentiles, server RSS per
+session and server event loop lag. Results are written as JSON so runs on
+different commits can be compared::
+
+    python -m benchmarks.loadgen --clients 2000 --output before.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import uuid
+from datetime import timedelta
+
+import aiohttp
+from aiohttp import web
+
+from protocol import MSG_MESSAGE
+from session_manager import SessionManager
+from transport import WebSocketServerHLEB
+
+
+def rss():
+    """Resident set size of this process, bytes."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def percentiles(values):
+    if not values:
+        return {}
+
+    values = sorted(values)
+    last = len(values) - 1
+    return {
+        "p50": values[int(last * 0.5)],
+        "p99": values[int(last * 0.99)],
+        "p999": values[int(last * 0.999)],
+        "max": values[last],
+        "count": len(values),
+    }
+
+
+class LagMonitor(object):
+    """Measures how late the event loop wakes up from short sleeps."""
+
+    def __init__(self, loop, interval=0.01):
+        self.loop = loop
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        while True:
+            started = self.loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(
+                self.loop.time() - started - self.interval)
+
+    def reset(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+
+# Server
+# ---------------------
+
+async def echo_handler(msg, session):
+    if msg.type == MSG_MESSAGE:
+        session.send(msg.data)
+
+
+async def websocket(manager, request):
+    session = manager.get(str(uuid.uuid4()), True)
+
+    transport = WebSocketServerHLEB(manager, session, request)
+    try:
+        return await transport.process()
+    except asyncio.CancelledError:
+        raise
+    except web.HTTPException as exc:
+        return exc
+
+
+async def broadcast(manager, count, interval, size):
+    padding = "x" * size
+    for seq in range(count):
+        manager.broadcast(json.dumps(
+            {"seq": seq, "t": time.time(), "pad": padding}))
+        await asyncio.sleep(interval)
+
+
+def build_app(loop, options):
+    app = web.Application()
+    manager = SessionManager(
+        app, echo_handler, loop,
+        heartbeat=options["heartbeat"],
+        timeout=timedelta(seconds=options["timeout"]),
+        max_queue=options["max_queue"])
+    monitor = LagMonitor(loop)
+
+    async def stats(request):
+        if request.query.get("reset"):
+            monitor.reset()
+        return web.json_response({
+            "sessions": len(manager),
+            "acquired": len(manager.acquired),
+            "rss": rss(),
+            "lag": percentiles(monitor.samples),
+            "overflows": dict(manager.overflows),
+        })
+
+    async def start_broadcast(request):
+        asyncio.ensure_future(broadcast(
+            manager,
+            int(request.query["count"]),
+            float(request.query["interval"]),
+            int(request.query.get("size", 0))), loop=loop)
+        return web.json_response({})
+
+    app.router.add_get("/ws", lambda request: websocket(manager, request))
+    app.router.add_get("/bench/stats", stats)
+    app.router.add_post("/bench/broadcast", start_broadcast)
+
+    manager.start()
+    asyncio.ensure_future(monitor.run(), loop=loop)
+    return app
+
+
+def serve(port, options, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    runner = web.AppRunner(build_app(loop, options))
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(
+        web.TCPSite(runner, "127.0.0.1", port).start())
+
+    ready.set()
+    loop.run_forever()
+
+
+# Clients
+# ---------------------
+
+class Bench(object):
+
+    def __init__(self, client, port, args):
+        self.client = client
+        self.base = "http://127.0.0.1:%d" % port
+        self.args = args
+
+    async def stats(self, reset=False):
+        params = {"reset": "1"} if reset else {}
+        async with self.client.get(
+                self.base + "/bench/stats", params=params) as resp:
+            return await resp.json()
+
+    async def start_broadcast(self, count, interval, size=0):
+        async with self.client.post(
+                self.base + "/bench/broadcast",
+                params={"count": count, "interval": interval,
+                        "size": size}) as resp:
+            await resp.read()
+
+    async def connect(self, count):
+        semaphore = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def connect_one():
+            async with semaphore:
+                return await self.client.ws_connect(self.base + "/ws")
+
+        return await asyncio.gather(*(connect_one() for _ in range(count)))
+
+    async def wait_sessions(self, count, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            stats = await self.stats()
+            if stats["acquired"] >= count:
+                return stats
+            await asyncio.sleep(0.05)
+        raise RuntimeError("Server did not acquire %d sessions" % count)
+
+    async def close(self, sockets):
+        await asyncio.gather(*(ws.close() for ws in sockets))
+
+    async def report(self, started, operations, latencies, before, clients):
+        elapsed = time.monotonic() - started
+        after = await self.stats()
+        return {
+            "clients": clients,
+            "elapsed": elapsed,
+            "operations": operations,
+            "throughput": operations / elapsed if elapsed else 0.0,
+            "latency": percentiles(latencies),
+            "rss_per_session": (
+                (after["rss"] - before["rss"]) / clients if clients else 0),
+            "loop_lag": after["lag"],
+            "overflows": after["overflows"],
+        }
+
+    async def receive_broadcast(self, ws, count, latencies):
+        received = 0
+        while received < count:
+            msg = await ws.receive()
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            latencies.append(time.time() - json.loads(msg.data)["t"])
+            received += 1
+        return received
+
+    async def broadcast(self):
+        args = self.args
+        before = await self.stats()
+        sockets = await self.connect(args.clients)
+        await self.wait_sessions(args.clients)
+        await self.stats(reset=True)
+
+        latencies = []
+        started = time.monotonic()
+        await self.start_broadcast(args.messages, args.interval, args.size)
+        received = await asyncio.gather(*(
+            self.receive_broadcast(ws, args.messages, latencies)
+            for ws in sockets))
+
+        result = await self.report(
+            started, sum(received), latencies, before, args.clients)
+        await self.close(sockets)
+        return result
+
+    async def echo_client(self, ws, count, latencies):
+        for seq in range(count):
+            await ws.send_str(repr(time.time()))
+            msg = await ws.receive()
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                return seq
+            latencies.append(time.time() - float(msg.data))
+        return count
+
+    async def echo(self):
+        args = self.args
+        before = await self.stats()
+        sockets = await self.connect(args.clients)
+        await self.wait_sessions(args.clients)
+        await self.stats(reset=True)
+
+        latencies = []
+        started = time.monotonic()
+        echoed = await asyncio.gather(*(
+            self.echo_client(ws, args.messages, latencies)
+            for ws in sockets))
+
+        result = await self.report(
+            started, sum(echoed), latencies, before, args.clients)
+        await self.close(sockets)
+        return result
+
+    async def churn_client(self, deadline, latencies):
+        count = 0
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            ws = await self.client.ws_connect(self.base + "/ws")
+            latencies.append(time.monotonic() - started)
+            await ws.close()
+            count += 1
+        return count
+
+    async def churn(self):
+        args = self.args
+        before = await self.stats()
+        await self.stats(reset=True)
+
+        latencies = []
+        started = time.monotonic()
+        deadline = started + args.duration
+        connects = await asyncio.gather(*(
+            self.churn_client(deadline, latencies)
+            for _ in range(args.connect_concurrency)))
+
+        return await self.report(
+            started, sum(connects), latencies, before, 0)
+
+    async def expiry(self):
+        args = self.args
+        before = await self.stats()
+        sockets = await self.connect(args.clients)
+        await self.wait_sessions(args.clients)
+        await self.stats(reset=True)
+
+        started = time.monotonic()
+        for ws in sockets:
+            ws._writer.transport.abort()
+
+        deadline = started + args.timeout + args.heartbeat * 2 + 30
+        while time.monotonic() < deadline:
+            if not (await self.stats())["sessions"]:
+                break
+            await asyncio.sleep(0.1)
+
+        return await self.report(started, args.clients, [], before, 0)
+
+    async def slow(self):
+        args = self.args
+        before = await self.stats()
+        sockets = await self.connect(args.clients)
+        await self.wait_sessions(args.clients)
+
+        slow_count = int(args.clients * args.slow_fraction)
+        for ws in sockets[:slow_count]:
+            ws._writer.transport.pause_reading()
+        await self.stats(reset=True)
+
+        latencies = []
+        started = time.monotonic()
+        await self.start_broadcast(args.messages, args.interval, args.size)
+        received = await asyncio.gather(*(
+            self.receive_broadcast(ws, args.messages, latencies)
+            for ws in sockets[slow_count:]))
+
+        result = await self.report(
+            started, sum(received), latencies, before, args.clients)
+        result["slow_clients"] = slow_count
+
+        for ws in sockets[:slow_count]:
+            ws._writer.transport.abort()
+        await self.close(sockets[slow_count:])
+        return result
+
+
+SCENARIOS = ("broadcast", "echo", "churn", "expiry", "slow")
+
+
+async def run(port, args):
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as client:
+        bench = Bench(client, port, args)
+
+        results = {}
+        for name in args.scenario:
+            print("running %s..." % name, file=sys.stderr)
+            results[name] = await getattr(bench, name)()
+        return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.01)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--slow-fraction", type=float, default=0.1)
+    parser.add_argument("--heartbeat", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=2.0)
+    parser.add_argument("--max-queue", type=int, default=1000)
+    parser.add_argument("--output", help="write JSON results to this file")
+
+    args = parser.parse_args(argv)
+    args.scenario = args.scenario or list(SCENARIOS)
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve, daemon=True,
+        args=(args.port, {"heartbeat": args.heartbeat,
+                          "timeout": args.timeout,
+                          "max_queue": args.max_queue}, ready))
+    server.start()
+    ready.wait()
+
+    loop = asyncio.get_event_loop()
+    try:
+        results = loop.run_until_complete(run(args.port, args))
+    finally:
+        server.terminate()
+        server.join()
+
+    report = {
+        "commit": commit(),
+        "time": time.time(),
+        "options": vars(args),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,243 @@
+"""Reconnecting WebSocket clients pooled by URL.
+
+Every client keeps one ``Session`` across connections: messages sent while
+it is disconnected stay queued and go out once it is back. Messages a
+dropped connection was writing at that moment are lost.
+"""
+import asyncio
+import logging
+import random
+from asyncio import ensure_future
+
+import aiohttp
+
+from protocol import CLOSE_RESTART, PRIORITY_NORMAL
+from protocol import STATE_OPEN, STATE_CLOSED
+from session import Session
+from transport import WebSocketTransport_HLEB
+
+log = logging.getLogger("sockjs")
+
+
+class Backoff(object):
+    """ Exponential backoff with full jitter
+    ``base``: Longest delay before the first retry, seconds
+    ``cap``: Longest delay overall, seconds
+    """
+
+    def __init__(self, base=0.1, cap=10.0):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+def _restart_delay(close_message):
+    """Reconnect delay a draining server asked for, seconds, or ``None``."""
+    if close_message is None:
+        return None
+
+    code, reason = close_message
+    if code != CLOSE_RESTART or not reason or not reason.isdigit():
+        return None
+    return int(reason) / 1000
+
+
+class ReconnectingClient(object):
+    """ Session kept connected to one URL
+    ``session``: ``Session`` of the link, the handler gets ``MSG_OPEN`` on the
+    first connection and ``MSG_CLOSED`` once the client is closed
+    ``backoff``: ``Backoff`` between failed attempts, a server restarting
+    with ``CLOSE_RESTART`` sets the delay itself
+    ``codecs``, ``compress``: see ``WebSocketClientHLEB``
+    ``connected``: connection is up
+    ``connects``: connections made
+    ``downtime``: seconds spent reconnecting after connections dropped
+
+    Other keyword arguments are passed to the transport.
+    """
+
+    def __init__(self, session, client_session, url, backoff=None,
+                 compress=0, codecs=(), **kwargs):
+        self.session = session
+        self.client_session = client_session
+        self.url = url
+        self.loop = session.loop
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.compress = compress
+        self.codecs = {codec.name: codec for codec in codecs}
+        self.kwargs = kwargs
+
+        self.connected = False
+        self.connects = 0
+        self.downtime = 0.0
+
+        self._task = None
+        self._up = None  # future for ``wait_connected``
+        self._dropped = None  # when the last connection went down
+
+    def start(self):
+        if self._task is None:
+            self._task = ensure_future(self._run(), loop=self.loop)
+
+    async def wait_connected(self, timeout=None):
+        if self.connected:
+            return
+
+        if self._up is None or self._up.done():
+            self._up = asyncio.Future(loop=self.loop)
+        await asyncio.wait_for(asyncio.shield(self._up), timeout)
+
+    def _connected(self):
+        self.connects += 1
+        self.connected = True
+        if self._dropped is not None:
+            self.downtime += self.loop.time() - self._dropped
+            self._dropped = None
+
+        if self._up is not None and not self._up.done():
+            self._up.set_result(None)
+
+    async def _connect(self):
+        """Run one connection, return the transport that ran it."""
+        transport = WebSocketTransport_HLEB(
+            self.session, self.loop, keep_session=True, **self.kwargs)
+
+        async with self.client_session.ws_connect(
+                self.url, compress=self.compress,
+                protocols=tuple(self.codecs)) as ws:
+            if ws.protocol in self.codecs:
+                self.session.codec = self.codecs[ws.protocol]
+
+            await self.session._acquire(None, heartbeat=False)
+            self._connected()
+            try:
+                await transport.process(ws)
+            finally:
+                self.connected = False
+                self._dropped = self.loop.time()
+                self.session._release()
+
+        return transport
+
+    async def _run(self):
+        attempt = 0
+        while True:
+            delay = None
+            try:
+                transport = await self._connect()
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as exc:
+                log.debug("Can not connect to %s: %s", self.url, exc)
+                attempt += 1
+            else:
+                attempt = 0
+                delay = _restart_delay(transport.close_message)
+
+            if self.session.state == STATE_CLOSED:
+                break
+
+            if delay is None:
+                delay = self.backoff.delay(attempt)
+            await asyncio.sleep(delay)
+
+    async def close(self, timeout=1.0):
+        """Close the session, queued messages are dropped."""
+        if self.session.state == STATE_OPEN:
+            self.session.close()
+
+        if self._task is not None:
+            done, _ = await asyncio.wait((self._task,), timeout=timeout)
+            if not done:
+                self._task.cancel()
+                await asyncio.wait((self._task,))
+
+        await self.session._remote_closed()
+
+
+class ClientPool(object):
+    """ Reconnecting clients by URL
+    ``handler``: Handler of the pooled sessions
+    ``size``: Connections per URL, sends are spread over them
+    ``client_session``: ``aiohttp.ClientSession`` to connect with, the pool
+    creates one and closes it with itself by default
+    ``session_kwargs``: Passed to new ``Session``, e.g. ``max_queue``
+
+    Other keyword arguments are passed to ``ReconnectingClient``.
+    """
+
+    def __init__(self, handler, loop=None, size=1, client_session=None,
+                 session_kwargs=None, **kwargs):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        self.handler = handler
+        self.loop = loop
+        self.size = size
+        self.session_kwargs = session_kwargs or {}
+        self.kwargs = kwargs
+        self.clients = {}  # url -> list of ``ReconnectingClient``
+
+        self._client_session = client_session
+        self._owns_client_session = client_session is None
+        self._next = {}  # url -> index of the next client to send on
+
+    @property
+    def client_session(self):
+        if self._client_session is None:
+            self._client_session = aiohttp.ClientSession()
+        return self._client_session
+
+    def get(self, url):
+        """Clients of the URL, connecting in the background."""
+        clients = self.clients.get(url)
+        if clients is None:
+            clients = self.clients[url] = []
+            for idx in range(self.size):
+                session = Session(
+                    "%s#%d" % (url, idx), self.handler, loop=self.loop,
+                    **self.session_kwargs)
+                client = ReconnectingClient(
+                    session, self.client_session, url, **self.kwargs)
+                client.start()
+                clients.append(client)
+        return clients
+
+    async def warm(self, url, timeout=None):
+        """Connect the clients of the URL ahead of the first send."""
+        await asyncio.gather(*(
+            client.wait_connected(timeout) for client in self.get(url)))
+
+    def session(self, url):
+        """Session to send on, connected ones first, round robin."""
+        clients = self.get(url)
+        start = self._next.get(url, 0)
+
+        for offset in range(len(clients)):
+            idx = (start + offset) % len(clients)
+            if clients[idx].connected:
+                break
+        else:
+            # all are down, queue until one is back
+            idx = start % len(clients)
+
+        self._next[url] = idx + 1
+        return clients[idx].session
+
+    def send(self, url, msg, key=None, priority=PRIORITY_NORMAL):
+        self.session(url).send(msg, key, priority)
+
+    def send_obj(self, url, obj, key=None, priority=PRIORITY_NORMAL):
+        self.session(url).send_obj(obj, key, priority)
+
+    async def close(self, timeout=1.0):
+        clients = [client for clients in self.clients.values()
+                   for client in clients]
+        self.clients = {}
+        await asyncio.gather(*(client.close(timeout) for client in clients))
+
+        if self._owns_client_session and self._client_session is not None:
+            await self._client_session.close()
+        self._client_session = None
@@ -0,0 +1,119 @@
+"""Message codecs.
+
+JSON uses the fastest library installed (orjson, ujson, stdlib json),
+msgpack is available when the ``msgpack`` package is installed. Codecs are
+negotiated per connection through the WebSocket subprotocol named after
+them.
+"""
+import json
+
+from protocol import TextFrame, encode_text
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(object):
+    """ Message codec
+    ``name``: WebSocket subprotocol name
+    ``binary``: Encoded messages are sent as binary frames
+    """
+
+    name = None
+    binary = False
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def encode_frame(self, obj):
+        """Encode for fan-out, the result is shared by all recipients."""
+        return encode_text(self.encode(obj))
+
+    def decode(self, data):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+
+class JsonCodec(Codec):
+    """ JSON codec
+    ``backend``: "orjson", "ujson" or "json", the fastest installed one
+    by default
+    """
+
+    name = "json"
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = "orjson" if orjson else "ujson" if ujson else "json"
+        self.backend = backend
+
+        if backend == "orjson":
+            self._dumps = orjson.dumps
+            self._loads = orjson.loads
+        elif backend == "ujson":
+            self._dumps = ujson.dumps
+            self._loads = ujson.loads
+        elif backend == "json":
+            self._dumps = json.JSONEncoder(
+                ensure_ascii=False, separators=(",", ":")).encode
+            self._loads = json.loads
+        else:
+            raise ValueError("Unknown JSON backend: %r" % backend)
+
+    def encode(self, obj):
+        data = self._dumps(obj)
+        if isinstance(data, bytes):
+            return data.decode("utf-8")
+        return data
+
+    def encode_frame(self, obj):
+        data = self._dumps(obj)
+        if isinstance(data, bytes):
+            # orjson already produced UTF-8
+            return TextFrame(data)
+        return encode_text(data)
+
+    def decode(self, data):
+        return self._loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed")
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    encode_frame = encode
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+DEFAULT_CODEC = JsonCodec()
+
+
+def available_codecs():
+    """Codecs usable with the installed packages, preferred first."""
+    codecs = [DEFAULT_CODEC]
+    if msgpack is not None:
+        codecs.insert(0, MsgpackCodec())
+    return codecs
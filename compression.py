@@ -0,0 +1,82 @@
+"""Pre-compressed permessage-deflate frames.
+
+A message deflated without context takeover compresses to the same bytes
+for every connection that negotiated the same window size, so broadcast
+payloads are compressed once per profile and the finished frame is shared.
+Connections keeping the context compress on their own.
+"""
+import struct
+import zlib
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_PING = 0x9
+
+_FIN = 0x80
+_RSV1 = 0x40
+_TAIL = b"\x00\x00\xff\xff"
+
+_LEN16 = struct.Struct("!BBH")
+_LEN64 = struct.Struct("!BBQ")
+
+
+def deflate(payload, wbits=zlib.MAX_WBITS, level=zlib.Z_DEFAULT_COMPRESSION):
+    """Compress a message without context takeover (RFC 7692)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -wbits)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    if data.endswith(_TAIL):
+        data = data[:-4]
+    return data
+
+
+def frame_header(size, opcode=OPCODE_TEXT, compressed=False):
+    """Header of an unmasked, final frame as written by a server."""
+    first = _FIN | opcode
+    if compressed:
+        first |= _RSV1
+
+    if size < 126:
+        return bytes((first, size))
+    elif size < 65536:
+        return _LEN16.pack(first, 126, size)
+    else:
+        return _LEN64.pack(first, 127, size)
+
+
+def build_frame(payload, opcode=OPCODE_TEXT, compressed=False):
+    """Unmasked, final frame as written by a server."""
+    return frame_header(len(payload), opcode, compressed) + payload
+
+
+def deflated_frame(message, wbits, opcode=OPCODE_TEXT):
+    """Compressed frame for a shared message, built once per window size.
+
+    ``message`` is a ``TextFrame`` or bytes; frames are cached on it when it
+    has a ``deflated`` attribute.
+    """
+    cache = getattr(message, "deflated", None)
+    if cache is not None and wbits in cache:
+        return cache[wbits]
+
+    frame = build_frame(deflate(message, wbits), opcode, compressed=True)
+
+    if hasattr(message, "deflated"):
+        if cache is None:
+            cache = message.deflated = {}
+        cache[wbits] = frame
+    return frame
+
+
+def shared_profile(ws):
+    """Window size for connections that can share compressed frames.
+
+    Returns ``None`` without compression or with context takeover.
+    """
+    wbits = ws.compress
+    writer = ws._writer
+    if not wbits or writer is None or not writer.notakeover:
+        return None
+    return wbits
+
+
+PING_FRAME = build_frame(b"", OPCODE_PING)
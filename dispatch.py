@@ -0,0 +1,161 @@
+"""Handler dispatch off the transport receive loop."""
+import asyncio
+import collections
+import logging
+from asyncio import ensure_future
+
+log = logging.getLogger("sockjs")
+
+
+class HandlerStats(object):
+    """ Timings of one handler, seconds
+    ``calls``: Finished calls
+    ``errors``: Calls that raised
+    ``wait``, ``wait_max``: Time messages spent queued before the call
+    ``run``, ``run_max``: Time spent in the handler
+    """
+
+    __slots__ = ("calls", "errors", "wait", "wait_max", "run", "run_max")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.wait = 0.0
+        self.wait_max = 0.0
+        self.run = 0.0
+        self.run_max = 0.0
+
+    def add(self, wait, run):
+        self.calls += 1
+        self.wait += wait
+        self.run += run
+        if wait > self.wait_max:
+            self.wait_max = wait
+        if run > self.run_max:
+            self.run_max = run
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Dispatcher(object):
+    """ Runs session handlers concurrently across sessions
+    ``concurrency``: Handlers running at once over all sessions, 0 for no limit
+    ``max_pending``: Messages queued per session before the transport stops
+    reading from it, 0 for no limit
+    ``executor``: Executor for handlers that are plain functions
+    ``stats``: ``HandlerStats`` by handler name
+
+    Messages of one session are handled in order, one at a time. A plain
+    function handler runs in ``executor`` as ``handler(msg)``, it does not
+    get the session so thread and process pools both work. Anything it
+    returns other than ``None`` is sent back, a list is sent message by
+    message.
+    """
+
+    def __init__(self, concurrency=0, max_pending=0, executor=None,
+                 loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.executor = executor
+        self.loop = loop
+        self.stats = {}
+
+        self._semaphore = None
+        self._inboxes = {}  # session -> deque of (queued at, message)
+        self._workers = {}  # session -> task draining its inbox
+
+    def _handler_stats(self, handler):
+        name = getattr(handler, "__qualname__", None) or repr(handler)
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = HandlerStats()
+        return stats
+
+    def pending(self, session):
+        inbox = self._inboxes.get(session)
+        return len(inbox) if inbox else 0
+
+    def snapshot(self):
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
+
+    async def dispatch(self, session, msg):
+        """Queue message for the session handler."""
+        if self.max_pending and self.pending(session) >= self.max_pending:
+            await self.flush(session)
+
+        inbox = self._inboxes.get(session)
+        if inbox is None:
+            inbox = self._inboxes[session] = collections.deque()
+        inbox.append((self.loop.time(), msg))
+
+        if session not in self._workers:
+            self._workers[session] = ensure_future(
+                self._work(session, inbox), loop=self.loop)
+
+    async def flush(self, session):
+        """Wait until queued messages of the session are handled."""
+        worker = self._workers.get(session)
+        if worker is not None:
+            await asyncio.shield(worker)
+
+    async def _work(self, session, inbox):
+        try:
+            while inbox:
+                queued, msg = inbox.popleft()
+                try:
+                    await self.call(session, msg, queued)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    if session.metrics is not None:
+                        session.metrics.handler_errors.value += 1
+                    log.exception("Exception in message handler.")
+        finally:
+            del self._workers[session]
+            del self._inboxes[session]
+
+    async def call(self, session, msg, queued=None):
+        """Run the session handler for a message and record timings."""
+        stats = self._handler_stats(session.handler)
+
+        if self.concurrency:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+            async with self._semaphore:
+                await self._run(session, msg, stats, queued)
+        else:
+            await self._run(session, msg, stats, queued)
+
+    async def _run(self, session, msg, stats, queued):
+        handler = session.handler
+        started = self.loop.time()
+
+        try:
+            if (self.executor is not None and
+                    not asyncio.iscoroutinefunction(handler)):
+                reply = await self.loop.run_in_executor(
+                    self.executor, handler, msg)
+                if isinstance(reply, list):
+                    for item in reply:
+                        session.send(item)
+                elif reply is not None:
+                    session.send(reply)
+            else:
+                await handler(msg, session)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            finished = self.loop.time()
+            wait = started - queued if queued is not None else 0.0
+            stats.add(wait, finished - started)
+
+            metrics = session.metrics
+            if metrics is not None:
+                metrics.handler_time.observe(finished - started)
+                if queued is not None:
+                    metrics.queue_wait.observe(wait)
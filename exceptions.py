@@ -10,4 +10,8 @@ class SessionIsAcquired(SockjsException):
 
 
 class SessionIsClosed(SockjsException):
-    """Session is closed."""
\ No newline at end of file
+    """Session is closed."""
+
+
+class TooManySessions(SockjsException):
+    """New session refused by admission control."""
@@ -0,0 +1,190 @@
+"""Session handoff between processes for restarts.
+
+A draining process saves the state of its open sessions: id, timeout,
+sequence number, topics, queued messages and the replay ring. The
+replacement restores them and clients resume where they left off. State
+is written as JSON lines, text messages as text, binary ones base64
+encoded, to a file or to a Unix socket the replacement listens on.
+"""
+import asyncio
+import base64
+import collections
+import json
+import logging
+import os
+import stat
+
+from protocol import ENCODING, FRAME_BINARY, PRIORITY_HIGH, PRIORITY_NORMAL
+from protocol import STATE_OPEN
+
+log = logging.getLogger("sockjs")
+
+
+def _dump_message(frame, data):
+    if frame == FRAME_BINARY:
+        return [frame, base64.b64encode(data).decode("ascii")]
+    if isinstance(data, bytes):
+        data = data.decode(ENCODING)  # ``TextFrame``
+    return [frame, data]
+
+
+def _load_message(frame, data):
+    if frame == FRAME_BINARY:
+        return frame, base64.b64decode(data)
+    return frame, data
+
+
+def _native(value):
+    """Whether a key or topic survives JSON, tuples come back by
+    ``_hashable``."""
+    if isinstance(value, tuple):
+        return all(_native(item) for item in value)
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+def _hashable(value):
+    # saved keys and topics are hashable, an array was a tuple
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+def _dump_item(item):
+    message = _dump_message(item[0], item[1])
+    if len(item) > 2:
+        if _native(item[2]):
+            message.append(item[2])
+        else:
+            log.warning("Conflation key %.50r not saved.", item[2])
+    return message
+
+
+def dump_session(session):
+    """State of a session as a JSON serializable dict.
+
+    Conflation keys and topics that are not strings, numbers or tuples of
+    them are left out, their messages are saved without the key.
+    """
+    def queued(queue):
+        return [_dump_item(item) for item in queue or ()]
+
+    topics = []
+    for topic in session.topics or ():
+        if _native(topic):
+            topics.append(topic)
+        else:
+            log.warning("Topic %.50r not saved.", topic)
+
+    return {
+        "id": session.id,
+        "timeout": session.timeout,
+        "sent_seq": session.sent_seq,
+        "topics": topics,
+        "urgent": queued(session._urgent),
+        "queue": queued(session._queue),
+        "replay": [[seq] + _dump_message(frame, data)
+                   for seq, frame, data in session._replay or ()],
+    }
+
+
+def restore_session(manager, state, timeout=None):
+    """Add a session saved by ``dump_session`` to the manager.
+
+    It is open, waiting for its client to ``resume`` it within ``timeout``
+    seconds, the session timeout by default.
+    """
+    session = manager._create(state["id"])
+    session.state = STATE_OPEN
+    session._tick(state["timeout"] if timeout is None else timeout)
+    manager._add(session)
+
+    for priority, name in ((PRIORITY_HIGH, "urgent"),
+                           (PRIORITY_NORMAL, "queue")):
+        for item in state[name]:
+            frame, data = _load_message(item[0], item[1])
+            key = _hashable(item[2]) if len(item) > 2 else None
+            session._feed(frame, data, key, priority)
+
+    session.sent_seq = state["sent_seq"]
+    if session.replay:
+        session._replay = collections.deque(
+            ((seq,) + _load_message(frame, data)
+             for seq, frame, data in state["replay"]),
+            maxlen=session.replay)
+
+    for topic in state["topics"]:
+        manager.subscribe(session, _hashable(topic))
+    return session
+
+
+def _encode(states):
+    return "".join(
+        json.dumps(state, separators=(",", ":")) + "\n"
+        for state in states).encode(ENCODING)
+
+
+def _decode(data):
+    return [json.loads(line) for line in data.decode(ENCODING).splitlines()
+            if line]
+
+
+def _is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+async def save(path, states):
+    """Send states to the process listening on the Unix socket at ``path``,
+    write them to the file ``path`` when nothing listens there."""
+    data = _encode(states)
+
+    if _is_socket(path):
+        _, writer = await asyncio.open_unix_connection(path)
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+        return
+
+    temp = "%s.%d" % (path, os.getpid())
+    with open(temp, "wb") as output:
+        output.write(data)
+    os.replace(temp, path)
+
+
+async def load(path, loop, timeout=None):
+    """States saved to the file ``path``, the file is removed.
+
+    Without a file, listens on a Unix socket at ``path`` until the old
+    process connects or ``timeout`` seconds pass, then returns no states.
+    """
+    if os.path.isfile(path):
+        with open(path, "rb") as source:
+            data = source.read()
+        os.unlink(path)
+        return _decode(data)
+
+    received = asyncio.Future(loop=loop)
+
+    async def accept(reader, writer):
+        try:
+            data = await reader.read()
+        finally:
+            writer.close()
+        if not received.done():
+            received.set_result(data)
+
+    if _is_socket(path):
+        os.unlink(path)  # left over from a crashed process
+    server = await asyncio.start_unix_server(accept, path)
+    try:
+        data = await asyncio.wait_for(received, timeout)
+    except asyncio.TimeoutError:
+        return []
+    finally:
+        server.close()
+        if _is_socket(path):
+            os.unlink(path)
+
+    return _decode(data)
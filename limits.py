@@ -0,0 +1,59 @@
+"""Inbound rate limits."""
+from protocol import LIMIT_THROTTLE
+
+
+class TokenBucket(object):
+    """ Token bucket that can go into debt
+    ``rate``: Tokens added per second
+    ``capacity``: Most tokens held, the burst allowed at once
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, count, now):
+        """Take tokens, return seconds until the debt is paid off."""
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.capacity:
+            tokens = self.capacity
+        tokens -= count
+
+        self.tokens = tokens
+        self.updated = now
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+
+class RateLimit(object):
+    """ Inbound limits of a session
+    ``rate``: Messages per second, 0 for no limit
+    ``byte_rate``: Message bytes per second, 0 for no limit
+    ``burst``: Seconds worth of traffic accepted at once
+    ``action``: ``LIMIT_THROTTLE`` stops reading from the connection until
+    the client is back within the limit, ``LIMIT_CLOSE`` closes the session
+    ``close``: Close code and reason for ``LIMIT_CLOSE``
+
+    One ``RateLimit`` is shared by many sessions, each gets its own buckets.
+    """
+
+    def __init__(self, rate=0, byte_rate=0, burst=1.0,
+                 action=LIMIT_THROTTLE, close=(3002, "Rate limit exceeded")):
+        self.rate = rate
+        self.byte_rate = byte_rate
+        self.burst = burst
+        self.action = action
+        self.close = close
+
+    def buckets(self, now):
+        """Message and byte buckets for a session, ``None`` if not limited."""
+        return (
+            TokenBucket(self.rate, max(self.rate * self.burst, 1), now)
+            if self.rate else None,
+            TokenBucket(self.byte_rate, self.byte_rate * self.burst, now)
+            if self.byte_rate else None)
@@ -0,0 +1,220 @@
+"""Metrics for sessions, queues and transports.
+
+Instruments are plain counters updated in place, they are read with
+``snapshot()``, rendered for Prometheus or pushed to hooks.
+"""
+import bisect
+import logging
+
+log = logging.getLogger("sockjs")
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0)
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    kind = "counter"
+
+    __slots__ = ("name", "help", "value")
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def snapshot(self):
+        return self.value
+
+    def samples(self):
+        yield self.name, None, self.value
+
+
+class Gauge(object):
+    """Gauge read from ``fn`` on demand.
+
+    ``fn`` returns a number, or a dict of numbers by ``label`` value.
+    """
+    kind = "gauge"
+
+    __slots__ = ("name", "help", "fn", "label")
+
+    def __init__(self, name, fn, help="", label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+
+    def snapshot(self):
+        return self.fn()
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            for label, item in sorted(value.items()):
+                yield self.name, {self.label: label}, item
+        else:
+            yield self.name, None, value
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    __slots__ = ("name", "help", "buckets", "counts", "sum", "count")
+
+    def __init__(self, name, help="", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            "buckets": dict(zip(self.buckets + (float("inf"),),
+                                self._cumulative())),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+    def _cumulative(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+    def samples(self):
+        bounds = self.buckets + (float("inf"),)
+        for bound, total in zip(bounds, self._cumulative()):
+            yield self.name + "_bucket", {"le": _format(bound)}, total
+        yield self.name + "_sum", None, self.sum
+        yield self.name + "_count", None, self.count
+
+
+class Metrics(object):
+    """Registry of instruments with pull and push access."""
+
+    def __init__(self):
+        self.instruments = {}
+        self.hooks = []
+
+    def _register(self, instrument):
+        if instrument.name in self.instruments:
+            raise ValueError("Metric already registered: %s" % instrument.name)
+        self.instruments[instrument.name] = instrument
+        return instrument
+
+    def counter(self, name, help=""):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, fn, help="", label=None):
+        return self._register(Gauge(name, fn, help, label))
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def snapshot(self):
+        return {name: instrument.snapshot()
+                for name, instrument in self.instruments.items()}
+
+    def prometheus(self):
+        """Text exposition format."""
+        lines = []
+        for name, instrument in sorted(self.instruments.items()):
+            if instrument.help:
+                lines.append("# HELP %s %s" % (name, instrument.help))
+            lines.append("# TYPE %s %s" % (name, instrument.kind))
+
+            for sample, labels, value in instrument.samples():
+                if labels:
+                    sample += "{%s}" % ",".join(
+                        '%s="%s"' % item for item in sorted(labels.items()))
+                lines.append("%s %s" % (sample, _format(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def add_hook(self, hook):
+        """Call ``hook(snapshot)`` on every ``push()``."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def push(self):
+        if not self.hooks:
+            return
+
+        snapshot = self.snapshot()
+        for hook in self.hooks:
+            try:
+                hook(snapshot)
+            except Exception:
+                log.exception("Exception in metrics hook.")
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        return web.Response(
+            text=self.prometheus(),
+            content_type="text/plain", charset="utf-8")
+
+    def setup(self, app, path="/metrics"):
+        """Serve the Prometheus endpoint on an aiohttp application."""
+        app.router.add_get(path, self.handle)
+
+
+class SessionMetrics(Metrics):
+    """Instruments updated by sessions, dispatchers and transports."""
+
+    def __init__(self):
+        super(SessionMetrics, self).__init__()
+
+        self.messages_in = self.counter(
+            "sockjs_messages_in_total", "Messages received")
+        self.bytes_in = self.counter(
+            "sockjs_bytes_in_total", "Message bytes received")
+        self.messages_out = self.counter(
+            "sockjs_messages_out_total", "Messages sent")
+        self.frames_out = self.counter(
+            "sockjs_frames_out_total", "Frames sent")
+        self.bytes_out = self.counter(
+            "sockjs_bytes_out_total", "Message bytes sent")
+        self.expired = self.counter(
+            "sockjs_expired_sessions_total", "Sessions expired")
+        self.handler_errors = self.counter(
+            "sockjs_handler_errors_total", "Exceptions raised by handlers")
+        self.rate_limited = self.counter(
+            "sockjs_rate_limited_total",
+            "Incoming message batches over the session rate limit")
+        self.refused = self.counter(
+            "sockjs_refused_sessions_total",
+            "New sessions refused by admission control")
+
+        self.handler_time = self.histogram(
+            "sockjs_handler_seconds", "Handler run time")
+        self.queue_wait = self.histogram(
+            "sockjs_queue_wait_seconds",
+            "Time messages wait for a dispatched handler")
+        self.send_time = self.histogram(
+            "sockjs_send_seconds", "Time to write a frame to the transport")
+
+    def sent(self, messages, frames, size, elapsed):
+        self.messages_out.value += messages
+        self.frames_out.value += frames
+        self.bytes_out.value += size
+        self.send_time.observe(elapsed)
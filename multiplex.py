@@ -0,0 +1,324 @@
+"""Many sessions over one WebSocket.
+
+Frames follow the SockJS websocket-multiplex convention::
+
+    sub,<channel>             open the channel
+    msg,<channel>,<payload>   message for the channel session
+    uns,<channel>             close the channel
+
+Binary messages carry the same header as bytes. Channel names must not
+contain commas. Every channel is a ``Session`` of its own with its id,
+handler and queue; the connection is pinged once for all of them.
+"""
+import asyncio
+import collections
+import logging
+import uuid
+from asyncio import ensure_future
+
+from aiohttp import web
+
+from exceptions import SessionIsClosed, TooManySessions
+from protocol import MUX_SUB, MUX_MSG, MUX_UNS, encode_mux, decode_mux
+from transport import CMD_OPEN, CMD_CLOSE, CMD_MESSAGE, CMD_BINARY, _send_text
+
+log = logging.getLogger("sockjs")
+
+
+class WebSocketMultiplexHLEB:
+    """WebSocket transport carrying many sessions.
+
+    ``manager``: ``SessionManager`` the channel sessions are created in, their
+    ids are ``<connection id>/<channel>``
+    ``heartbeat``: ping interval of the connection, seconds, 0 to not ping
+    ``quantum``: messages a channel writes per turn, channels with queued
+    messages take turns so a busy one does not hold up the others
+    ``receive_batch``: how many buffered incoming frames to read in one go
+    ``channels``: channel name -> session
+    """
+
+    announce = False  # send ``sub`` for channels opened on this side
+
+    def __init__(self, manager, loop, heartbeat=0, quantum=16,
+                 receive_batch=64):
+        self.manager = manager
+        self.loop = loop
+        self.heartbeat = heartbeat
+        self.quantum = quantum
+        self.receive_batch = receive_batch
+        self.id = uuid.uuid4().hex
+        self.channels = {}
+
+        self._pumps = {}  # session -> task feeding its messages to the writer
+        self._ready = collections.deque()  # (channel, frame, data, waiter)
+        self._wakeup = None
+
+    def session_id(self, channel):
+        return "%s/%s" % (self.id, channel)
+
+    async def _open_channel(self, channel):
+        """Session of the channel, ``None`` when the manager refuses it; the
+        channel is closed then and the other channels go on."""
+        session = self.channels.get(channel)
+        if session is not None:
+            return session
+
+        try:
+            session = self.manager.get(self.session_id(channel), True)
+        except TooManySessions as exc:
+            log.warning("Channel %.20r refused: %s", channel, exc)
+            await self._turn(channel, CMD_CLOSE, None)
+            return None
+        self.channels[channel] = session
+        await self.manager.acquire(session, heartbeat=False)
+
+        self._pumps[session] = ensure_future(
+            self._pump(channel, session), loop=self.loop)
+        return session
+
+    async def _close_channel(self, channel):
+        session = self.channels.pop(channel, None)
+        if session is None:
+            return
+
+        await session._remote_closed()
+        await self.manager.release(session)
+
+    async def _pump(self, channel, session):
+        quantum = self.quantum
+        try:
+            while self.channels.get(channel) is session:
+                try:
+                    frame, data = await session._wait()
+                except SessionIsClosed:
+                    break
+
+                if frame in (CMD_MESSAGE, CMD_BINARY):
+                    for idx in range(0, len(data), quantum):
+                        await self._turn(
+                            channel, frame, data[idx:idx + quantum])
+
+                elif frame == CMD_OPEN:
+                    if self.announce:
+                        await self._turn(channel, CMD_OPEN, None)
+
+                elif frame == CMD_CLOSE:
+                    await self._turn(channel, CMD_CLOSE, None)
+                    await self._close_channel(channel)
+                    break
+
+                # heartbeats are sent for the whole connection
+        finally:
+            del self._pumps[session]
+
+    async def _turn(self, channel, frame, data):
+        """Wait until the writer got to these messages."""
+        waiter = asyncio.Future(loop=self.loop)
+        if data is None:
+            # channel control frames go ahead of queued messages
+            self._ready.appendleft((channel, frame, data, waiter))
+        else:
+            self._ready.append((channel, frame, data, waiter))
+
+        wakeup = self._wakeup
+        if wakeup is not None and not wakeup.done():
+            wakeup.set_result(None)
+
+        await waiter
+
+    async def _write(self, ws, channel, frame, data):
+        if frame == CMD_MESSAGE:
+            for msg in data:
+                await _send_text(ws, encode_mux(MUX_MSG, channel, msg))
+
+        elif frame == CMD_BINARY:
+            for payload in data:
+                await ws.send_bytes(encode_mux(MUX_MSG, channel, payload))
+
+        elif frame == CMD_OPEN:
+            await ws.send_str(encode_mux(MUX_SUB, channel))
+
+        elif frame == CMD_CLOSE:
+            await ws.send_str(encode_mux(MUX_UNS, channel))
+
+    async def writer(self, ws):
+        ready = self._ready
+        while True:
+            if not ready:
+                self._wakeup = asyncio.Future(loop=self.loop)
+                await self._wakeup
+                self._wakeup = None
+
+            channel, frame, data, waiter = ready.popleft()
+            if waiter.cancelled():
+                continue
+
+            started = self.loop.time()
+            await self._write(ws, channel, frame, data)
+            if not waiter.done():
+                waiter.set_result(None)
+
+            session = self.channels.get(channel)
+            if (session is not None and session.metrics is not None and
+                    frame in (CMD_MESSAGE, CMD_BINARY)):
+                session.metrics.sent(
+                    len(data), len(data), sum(len(msg) for msg in data),
+                    self.loop.time() - started)
+
+    async def _deliver(self, batch):
+        """Hand messages to channel sessions, return the longest throttle."""
+        delay = 0.0
+        for channel, messages in batch.items():
+            session = self.channels.get(channel)
+            if session is None:
+                continue
+
+            wait = session._throttle(messages)
+            if wait is not None:
+                await session._remote_messages(messages)
+                delay = max(delay, wait)
+        return delay
+
+    async def _control(self, tp, channel):
+        if tp == MUX_SUB:
+            await self._open_channel(channel)
+        elif tp == MUX_UNS:
+            await self._close_channel(channel)
+        else:
+            log.warning("Unknown multiplexed frame type: %.20r", tp)
+
+    def _tick(self):
+        for session in self.channels.values():
+            session._tick()
+
+    async def reader(self, ws):
+        pending = None
+
+        while True:
+            if pending is None:
+                msg = await ws.receive()
+            else:
+                msg, pending = pending, None
+
+            if msg.type in (web.WSMsgType.text, web.WSMsgType.binary):
+                batch = {}  # channel -> messages, in arrival order
+                count = 0
+                delay = 0.0
+
+                while True:
+                    try:
+                        tp, channel, payload = decode_mux(msg.data)
+                    except ValueError:
+                        log.warning("Malformed multiplexed frame.")
+                    else:
+                        if tp == MUX_MSG and payload is not None:
+                            batch.setdefault(channel, []).append(payload)
+                        else:
+                            # keep channel state in order with messages
+                            delay = max(delay, await self._deliver(batch))
+                            batch = {}
+                            await self._control(tp, channel)
+
+                    count += 1
+                    if not len(ws._reader) or count >= self.receive_batch:
+                        break
+
+                    # take frames already buffered on the socket along
+                    msg = await ws.receive()
+                    if msg.type not in (web.WSMsgType.text,
+                                        web.WSMsgType.binary):
+                        pending = msg
+                        break
+
+                delay = max(delay, await self._deliver(batch))
+                if delay:
+                    # one channel over its limit pauses the connection
+                    await asyncio.sleep(delay)
+
+            elif msg.type == web.WSMsgType.close:
+                for session in list(self.channels.values()):
+                    await session._remote_close()
+
+            elif msg.type in (web.WSMsgType.closed, web.WSMsgType.closing):
+                break
+
+            elif msg.type == web.WSMsgType.PING:
+                await ws.pong(msg.data)
+                self._tick()
+
+            elif msg.type == web.WSMsgType.PONG:
+                self._tick()
+
+    async def pinger(self, ws):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            await ws.ping()
+
+    async def process(self, ws):
+        tasks = [ensure_future(self.writer(ws), loop=self.loop),
+                 ensure_future(self.reader(ws), loop=self.loop)]
+        if self.heartbeat:
+            tasks.append(ensure_future(self.pinger(ws), loop=self.loop))
+
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks + list(self._pumps.values()):
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # a write to a dropped connection ends the loop
+                    task.exception()
+
+            for channel in list(self.channels):
+                await self._close_channel(channel)
+
+
+class WebSocketMultiplexServerHLEB(WebSocketMultiplexHLEB):
+    """Server side, the client opens the channels.
+
+    ``heartbeat`` defaults to the manager heartbeat.
+    """
+
+    def __init__(self, manager, request, heartbeat=None, **kwargs):
+        self.request = request
+        if heartbeat is None:
+            heartbeat = manager.heartbeat
+
+        super().__init__(
+            manager, request.app.loop, heartbeat=heartbeat, **kwargs)
+
+    async def process(self):
+        ws = web.WebSocketResponse(autoping=False)
+        await ws.prepare(self.request)
+
+        try:
+            await super().process(ws)
+        except Exception:  # should use specific exception
+            await ws.close(message="Go away!")
+
+        return ws
+
+
+class WebSocketMultiplexClientHLEB(WebSocketMultiplexHLEB):
+    """Client side, channels are opened with ``open``."""
+
+    announce = True
+
+    def __init__(self, manager, client_session, url, **kwargs):
+        self.client_session = client_session
+        self.url = url
+
+        super().__init__(manager, client_session.loop, **kwargs)
+
+    async def open(self, channel):
+        """Session of a new channel, it is announced once connected.
+
+        ``None`` when the manager refuses new sessions.
+        """
+        return await self._open_channel(channel)
+
+    async def process(self):
+        async with self.client_session.ws_connect(
+                self.url, autoping=False) as ws:
+            return await super().process(ws)
@@ -0,0 +1,152 @@
+"""Room membership and presence.
+
+Rooms are the topics of ``SessionManager``: sessions join with
+``subscribe`` and leave with ``unsubscribe`` or when they expire. With a
+``Presence`` the manager also counts the members that have a transport,
+keeps membership snapshots and tells subscribers who joined and left::
+
+    def changed(room, joined, left):
+        manager.publish(room, "%d online" % presence.connected(room))
+
+    presence = Presence(batch=0.1, subscribers=(changed,))
+    manager = SessionManager(app, handler, loop, presence=presence)
+
+Counts and snapshots are of this process only.
+"""
+import asyncio
+import logging
+
+log = logging.getLogger("sockjs")
+
+
+class Presence(object):
+    """ Presence of sessions in rooms
+    ``batch``: seconds to collect joins and leaves before calling the
+    subscribers once per room, 0 calls them on every change; a session that
+    joins and leaves within the window is not reported
+    ``subscribers``: callables getting ``fn(room, joined, left)``, lists of
+    sessions
+    """
+
+    def __init__(self, batch=0, subscribers=()):
+        self.batch = batch
+        self.subscribers = list(subscribers)
+        self.manager = None
+
+        self._connected = {}  # room -> members with a transport
+        self._snapshots = {}  # room -> frozenset of members
+        self._changes = {}  # room -> (joined, left) not reported yet
+        self._flush_handle = None
+
+    def _bind(self, manager):
+        if self.manager is not None and self.manager is not manager:
+            raise ValueError("Presence is used by another manager")
+        self.manager = manager
+
+    def subscribe(self, fn):
+        self.subscribers.append(fn)
+
+    def unsubscribe(self, fn):
+        self.subscribers.remove(fn)
+
+    def count(self, room):
+        """Sessions in the room."""
+        return len(self.manager.topics.get(room, ()))
+
+    def connected(self, room):
+        """Sessions in the room that have a transport."""
+        return self._connected.get(room, 0)
+
+    def members(self, room):
+        """Sessions in the room, a frozenset kept until it changes."""
+        snapshot = self._snapshots.get(room)
+        if snapshot is None:
+            members = self.manager.topics.get(room)
+            if not members:
+                return frozenset()
+            snapshot = self._snapshots[room] = frozenset(members)
+        return snapshot
+
+    def rooms(self):
+        """Number of sessions by room."""
+        return {room: len(members)
+                for room, members in self.manager.topics.items()}
+
+    def _count(self, room, delta):
+        count = self._connected.get(room, 0) + delta
+        if count:
+            self._connected[room] = count
+        else:
+            del self._connected[room]
+
+    def _acquired(self, session):
+        for room in session.topics or ():
+            self._count(room, 1)
+
+    def _released(self, session):
+        for room in session.topics or ():
+            self._count(room, -1)
+
+    def _joined(self, session, room, acquired):
+        self._snapshots.pop(room, None)
+        if acquired:
+            self._count(room, 1)
+        self._change(room, session, True)
+
+    def _left(self, session, room, acquired):
+        self._snapshots.pop(room, None)
+        if acquired:
+            self._count(room, -1)
+        self._change(room, session, False)
+
+    def _change(self, room, session, joined):
+        if not self.subscribers:
+            return
+
+        if not self.batch:
+            if joined:
+                self._emit(room, [session], [])
+            else:
+                self._emit(room, [], [session])
+            return
+
+        changes = self._changes.get(room)
+        if changes is None:
+            changes = self._changes[room] = ({}, {})
+        added, removed = changes if joined else changes[::-1]
+        # a leave cancels a join not reported yet and the other way around
+        if session in removed:
+            del removed[session]
+        else:
+            added[session] = None
+
+        if self._flush_handle is None:
+            loop = self.manager.loop
+            if loop is None:
+                loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.batch, self.flush)
+
+    def flush(self):
+        """Report collected joins and leaves now."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        changes, self._changes = self._changes, {}
+        for room, (joined, left) in changes.items():
+            if joined or left:
+                self._emit(room, list(joined), list(left))
+
+    def _emit(self, room, joined, left):
+        for fn in self.subscribers:
+            try:
+                fn(room, joined, left)
+            except Exception:
+                log.exception("Exception in presence subscriber.")
+
+    def close(self):
+        """Drop changes not reported yet."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._changes.clear()
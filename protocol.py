@@ -1,4 +1,5 @@
 import collections
+import json
 
 ENCODING = 'utf-8'
 
@@ -7,6 +8,58 @@ STATE_OPEN = 1
 STATE_CLOSING = 2
 STATE_CLOSED = 3
 
+# Send queue overflow policies
+# ---------------------
+
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_CONFLATE = 'conflate'
+OVERFLOW_CLOSE = 'close'
+
+# Close codes
+# ---------------------
+
+CLOSE_RESTART = 1012  # server restarts, reason is the reconnect delay in ms
+
+# Inbound rate limit actions
+# ---------------------
+
+LIMIT_THROTTLE = 'throttle'
+LIMIT_CLOSE = 'close'
+
+# Session frames
+# ---------------------
+# Values match the transport commands (``transport.CMD_*``).
+
+FRAME_OPEN = 1
+FRAME_CLOSE = 2
+FRAME_MESSAGE = 5
+FRAME_HEARTBEAT = 6
+FRAME_BINARY = 7
+
+DATA_FRAMES = (FRAME_MESSAGE, FRAME_BINARY)
+
+# Message priorities
+# ---------------------
+# Control frames go out first, then high priority messages, then the rest.
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+# Batched message frames
+# ---------------------
+# SockJS style ``a["msg1","msg2"]`` text frame carrying several messages.
+
+BATCH_PREFIX = 'a'
+
+# Multiplexed channel frames
+# ---------------------
+# SockJS websocket-multiplex style ``type,channel[,payload]`` frames.
+
+MUX_SUB = 'sub'
+MUX_MSG = 'msg'
+MUX_UNS = 'uns'
+
 # Handler messages
 # ---------------------
 
@@ -14,6 +67,22 @@ MSG_OPEN = 1
 MSG_MESSAGE = 2
 MSG_CLOSE = 3
 MSG_CLOSED = 4
+MSG_MESSAGES = 5  # list of messages, for handlers accepting batches
+
+
+class TextFrame(bytes):
+    """Text message encoded once and shared by all recipients.
+
+    ``deflated`` caches its compressed frames by window size.
+    """
+    deflated = None
+
+
+def encode_text(message):
+    """Encode a text message for fan-out, keep other payloads as they are."""
+    if isinstance(message, str):
+        return TextFrame(message.encode(ENCODING))
+    return message
 
 
 class SockjsMessage(collections.namedtuple('SockjsMessage', ['type', 'data'])):
@@ -25,3 +94,61 @@ class SockjsMessage(collections.namedtuple('SockjsMessage', ['type', 'data'])):
 OpenMessage = SockjsMessage(MSG_OPEN, None)
 CloseMessage = SockjsMessage(MSG_CLOSE, None)
 ClosedMessage = SockjsMessage(MSG_CLOSED, None)
+
+
+def encode_batch(messages):
+    """Pack messages into a single batch frame."""
+    return BATCH_PREFIX + json.dumps([
+        msg.decode(ENCODING) if isinstance(msg, TextFrame) else msg
+        for msg in messages])
+
+
+def decode_batch(data):
+    """Split a batch frame back into messages.
+
+    Raises ``ValueError`` for anything but a list of strings.
+    """
+    if not data.startswith(BATCH_PREFIX):
+        raise ValueError("Not a batch frame: %r" % data[:20])
+    messages = json.loads(data[len(BATCH_PREFIX):])
+    if not isinstance(messages, list):
+        raise ValueError("Batch frame must carry a list")
+    if not all(isinstance(msg, str) for msg in messages):
+        raise ValueError("Batch frame must carry strings")
+    return messages
+
+
+def encode_mux(type, channel, payload=None):
+    """Frame for a multiplexed channel.
+
+    A ``TextFrame`` payload gives a ``TextFrame``, a bytes-like one gives
+    bytes for a binary frame.
+    """
+    if payload is None:
+        return '%s,%s' % (type, channel)
+    if isinstance(payload, str):
+        return '%s,%s,%s' % (type, channel, payload)
+
+    header = ('%s,%s,' % (type, channel)).encode(ENCODING)
+    if isinstance(payload, TextFrame):
+        return TextFrame(header + payload)
+    return header + payload
+
+
+def decode_mux(data):
+    """Split a multiplexed frame into ``(type, channel, payload)``.
+
+    ``payload`` is ``None`` for control frames and keeps the type of
+    ``data`` otherwise.
+    """
+    if isinstance(data, str):
+        parts = data.split(',', 2)
+    else:
+        parts = data.split(b',', 2)
+        parts[:2] = [part.decode(ENCODING) for part in parts[:2]]
+
+    if len(parts) < 2:
+        raise ValueError("Not a multiplexed frame: %.20r" % (data,))
+    if len(parts) == 2:
+        parts.append(None)
+    return tuple(parts)
@@ -1,25 +1,61 @@
 import asyncio
 import datetime
+import os
 import uuid
 
 import aiohttp.web
 
-from protocol import MSG_OPEN, MSG_MESSAGE, MSG_CLOSED
+from protocol import MSG_OPEN, MSG_MESSAGE, MSG_CLOSED, OVERFLOW_CLOSE
 from session_manager import SessionManager
+from exceptions import TooManySessions
+from limits import RateLimit
+from metrics import SessionMetrics
+from multiplex import WebSocketMultiplexServerHLEB
+from presence import Presence
 from transport import WebSocketServerHLEB
 
 
+CHAT = "chat"
+
+
 async def chat_msg_handler(msg, session):
+    manager = session.manager
     if msg.type == MSG_OPEN:
-        session.manager.broadcast("Someone joined.")
+        manager.subscribe(session, CHAT)
     elif msg.type == MSG_MESSAGE:
-        session.manager.broadcast(msg.data)
-    elif msg.type == MSG_CLOSED:
-        session.manager.broadcast("Someone left.")
+        manager.publish(CHAT, msg.data)
+    elif msg.type == MSG_CLOSED and manager is not None:
+        manager.unsubscribe(session, CHAT)
+
+
+def chat_presence(manager):
+    # one announcement per batch, not one per session joining
+    def changed(room, joined, left):
+        manager.publish(room, "%d joined, %d left, %d online." % (
+            len(joined), len(left), manager.presence.connected(room)))
+    return changed
+
+
+def _seq(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
 
 
-async def websocket(manager, request):
-    session = manager.get(str(uuid.uuid4()), True)
+async def websocket(request):
+    manager = request.app["manager"]
+    session = None
+    # reconnect, ``seq`` is the number of messages received so far
+    seq = _seq(request.query.get("seq", "0"))
+    if "session" in request.query and seq is not None:
+        session = manager.resume(request.query["session"], seq)
+    if session is None:
+        try:
+            await manager.admit(timeout=5.0)
+            session = manager.get(str(uuid.uuid4()), True)
+        except TooManySessions as exc:
+            return aiohttp.web.HTTPServiceUnavailable(text=str(exc))
 
     transport = WebSocketServerHLEB(manager, session, request)
     try:
@@ -30,18 +66,73 @@ async def websocket(manager, request):
         return exc
 
 
+async def multiplexed(request):
+    transport = WebSocketMultiplexServerHLEB(request.app["manager"], request)
+    try:
+        return await transport.process()
+    except asyncio.CancelledError:
+        raise
+    except aiohttp.web.HTTPException as exc:
+        return exc
+
+
+HANDOFF = "/tmp/sockjs-handoff.jsonl"
+
+
 async def send_currenttime(manager):
     while True:
-        manager.broadcast("Payload: " + str(datetime.datetime.now()))
+        manager.broadcast(
+            "Payload: " + str(datetime.datetime.now()), key="currenttime")
         await asyncio.sleep(1)
 
 
-if __name__ == '__main__':
+async def start_manager(app):
+    # the event loop runs from here on, not when the app is built
+    manager = app["manager"] = SessionManager(
+        app, chat_msg_handler, asyncio.get_event_loop(), replay=100,
+        # a session falling this far behind, e.g. while its client is away,
+        # is closed rather than missing messages without the client knowing
+        max_queue=1000, overflow=OVERFLOW_CLOSE,
+        rate_limit=RateLimit(rate=50, byte_rate=64 * 1024),
+        max_sessions=10000, max_lag=0.5, presence=Presence(batch=0.5),
+        metrics=app["metrics"])
+    manager.presence.subscribe(chat_presence(manager))
+
+    # sessions of the previous process, clients resume them on reconnect
+    handoff = app["handoff"]
+    if handoff is not None and os.path.exists(handoff):
+        await manager.restore(handoff)
+
+    # heartbeats, expiry and the loop lag behind ``max_lag``
+    manager.start()
+    app["currenttime"] = asyncio.ensure_future(send_currenttime(manager))
+
+
+async def drain_manager(app):
+    app["currenttime"].cancel()
+    await app["manager"].drain(path=app["handoff"])
+
+
+async def stop_manager(app):
+    app["manager"].stop()
+
+
+def make_app(handoff=HANDOFF):
+    """Demo application, ``handoff``: file sessions are handed over in
+    between restarts, ``None`` to not hand them over."""
     app = aiohttp.web.Application()
+    app["handoff"] = handoff
+    app["metrics"] = SessionMetrics()
+
+    app.router.add_get("/ws", websocket)
+    app.router.add_get("/mux", multiplexed)
+    app["metrics"].setup(app, "/metrics")
 
-    manager = SessionManager(app, chat_msg_handler, app.loop)
+    app.on_startup.append(start_manager)
+    app.on_shutdown.append(drain_manager)
+    app.on_cleanup.append(stop_manager)
+    return app
 
-    app.router.add_get("/ws", lambda request: websocket(manager, request))
 
-    asyncio.ensure_future(send_currenttime(manager), loop=app.loop)
-    aiohttp.web.run_app(app)
+if __name__ == '__main__':
+    aiohttp.web.run_app(make_app())
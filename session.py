@@ -1,47 +1,233 @@
 import asyncio
 import collections
+import heapq
 import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
 
+from codec import DEFAULT_CODEC
 from exceptions import SessionIsClosed
-from protocol import FRAME_MESSAGE, FRAME_HEARTBEAT
+from protocol import FRAME_MESSAGE, FRAME_BINARY, FRAME_HEARTBEAT
+from protocol import DATA_FRAMES, PRIORITY_HIGH, PRIORITY_NORMAL
 from protocol import FRAME_OPEN, FRAME_CLOSE
-from protocol import MSG_CLOSE, MSG_MESSAGE
+from protocol import MSG_CLOSE, MSG_MESSAGE, MSG_MESSAGES
 from protocol import STATE_NEW, STATE_OPEN, STATE_CLOSING, STATE_CLOSED
-from protocol import SockjsMessage, OpenMessage, ClosedMessage
+from protocol import OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST
+from protocol import OVERFLOW_CONFLATE, OVERFLOW_CLOSE
+from protocol import LIMIT_CLOSE
+from protocol import SockjsMessage, OpenMessage, ClosedMessage, TextFrame
+from tracing import DEBUG_TRACER
+from tracing import TRACE_OPEN, TRACE_ACQUIRE, TRACE_RELEASE
+from tracing import TRACE_MESSAGE_IN, TRACE_MESSAGE_OUT
+from tracing import TRACE_CLOSE, TRACE_REMOTE_CLOSE, TRACE_CLOSED
 
 log = logging.getLogger("sockjs")
 
 
+def _seconds(timeout):
+    if isinstance(timeout, timedelta):
+        return timeout.total_seconds()
+    return timeout
+
+
+def _size(data):
+    if isinstance(data, memoryview):
+        return data.nbytes
+    return len(data)
+
+
+class SendQueueBudget(object):
+    """ Queued message bytes shared by the sessions of a manager
+    ``max_bytes``: Limit for all queues together, 0 for no limit
+    ``messages``: Currently queued messages
+    ``bytes``: Currently queued bytes
+    ``overflows``: How often each overflow policy triggered
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.messages = 0
+        self.bytes = 0
+        self.overflows = collections.Counter()
+
+
+class ExpiryWheel(object):
+    """ Sessions bucketed by deadline
+    ``granularity``: Width of a bucket, seconds
+
+    ``Session._tick`` moves a session to another bucket only when its
+    deadline crosses into it, in O(1). Sweeps visit the buckets that are
+    due and look at their sessions only, active sessions have their
+    deadlines in later buckets and are not touched.
+    """
+
+    def __init__(self, granularity=1.0):
+        self.granularity = granularity
+        self._buckets = {}  # index -> set of sessions
+        self._indexes = []  # heap of bucket indexes, buckets may be empty
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def schedule(self, session):
+        """Add the session, or move it after its deadline changed."""
+        index = int(session.expires // self.granularity)
+        current = session._bucket
+        if index == current:
+            return
+
+        if current is None:
+            session._wheel = self
+            self._size += 1
+        else:
+            self._buckets[current].discard(session)
+
+        bucket = self._buckets.get(index)
+        if bucket is None:
+            bucket = self._buckets[index] = set()
+            heapq.heappush(self._indexes, index)
+        bucket.add(session)
+        session._bucket = index
+
+    def discard(self, session):
+        index = session._bucket
+        if index is None:
+            return
+
+        self._buckets[index].discard(session)
+        session._bucket = None
+        session._wheel = None
+        self._size -= 1
+
+    def due(self, now):
+        """Remove and return sessions whose deadline has passed."""
+        buckets = self._buckets
+        indexes = self._indexes
+        due = []
+
+        while indexes and indexes[0] * self.granularity < now:
+            index = indexes[0]
+            bucket = buckets[index]
+
+            expired = [session for session in bucket if session.expires < now]
+            for session in expired:
+                self.discard(session)
+            due.extend(expired)
+
+            if bucket:
+                break  # ``now`` falls in this bucket, the rest expire later
+
+            heapq.heappop(indexes)
+            del buckets[index]
+
+        return due
+
+    def clear(self):
+        for bucket in self._buckets.values():
+            for session in bucket:
+                session._bucket = None
+                session._wheel = None
+        self._buckets.clear()
+        del self._indexes[:]
+        self._size = 0
+
+
 class Session(object):
     """ SockJS session object
     ``state``: Session state
     ``manager``: Session manager that hold this session
     ``acquired``: Acquired state, indicates that transport is using session
-    ``timeout``: Session timeout
+    ``timeout``: Session timeout, seconds or ``timedelta``
+    ``expires``: Deadline in ``loop.time()`` seconds
+    ``topics``: Topics the session is subscribed to, ``None`` for none
+    ``max_queue``: Send queue limit in messages, 0 for no limit
+    ``max_queue_bytes``: Send queue limit in bytes, 0 for no limit
+    ``overflow``: Policy applied when a limit is hit, ``OVERFLOW_*``
+    ``overflow_close``: Close code and reason for ``OVERFLOW_CLOSE``
+    ``budget``: ``SendQueueBudget`` shared with other sessions, optional
+    ``dispatcher``: ``Dispatcher`` running handlers off the receive loop,
+    handlers are awaited inline without it
+    ``batch_messages``: Deliver messages received together as one
+    ``MSG_MESSAGES`` message carrying a list, the handler still gets
+    ``MSG_MESSAGE`` for messages arriving alone
+    ``metrics``: ``SessionMetrics`` to update, optional
+    ``codec``: ``codec.Codec`` decoding incoming messages for the handler and
+    encoding ``send_obj``, messages are passed as they are without it
+    ``replay``: Number of sent messages kept for resuming the session after
+    the connection drops, 0 to close the session with the connection
+    ``sent_seq``: Sequence number of the last message handed to a transport,
+    messages are numbered from 1 in the order the client receives them
+    ``rate_limit``: ``limits.RateLimit`` for incoming messages, optional
+    ``tracer``: ``tracing.Tracer`` kept when it samples this session,
+    ``debug`` logs events without one
     """
 
-    manager = None
-    acquired = False
-    state = STATE_NEW
-    interrupted = False
-    exception = None
+    __slots__ = (
+        "id", "handler", "manager", "registry", "acquired", "state",
+        "interrupted", "exception", "expired", "timeout", "expires", "loop",
+        "topics", "max_queue", "max_queue_bytes", "overflow",
+        "overflow_close", "budget", "dispatcher", "batch_messages", "metrics",
+        "codec", "replay", "sent_seq", "rate_limit",
+        "_hits", "_heartbeats", "_heartbeat_transport", "tracer", "_waiter",
+        "_queue", "_queued", "_queued_bytes", "_keys", "_replay",
+        "_buckets", "_control", "_urgent", "_wheel", "_bucket")
 
     def __init__(self, id, handler, *,
-                 timeout=timedelta(seconds=10), loop=None, debug=False):
+                 timeout=timedelta(seconds=10), loop=None, debug=False,
+                 max_queue=0, max_queue_bytes=0,
+                 overflow=OVERFLOW_DROP_OLDEST,
+                 overflow_close=(3001, "Slow consumer"), budget=None,
+                 dispatcher=None, batch_messages=False, metrics=None,
+                 codec=None, replay=0, rate_limit=None, tracer=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
         self.id = id
         self.handler = handler
+        self.manager = None
+        self.registry = None
+        self.acquired = False
+        self.state = STATE_NEW
+        self.interrupted = False
+        self.exception = None
         self.expired = False
-        self.timeout = timeout
-        self.expires = datetime.now() + timeout
+        self.timeout = _seconds(timeout)
+        self.expires = loop.time() + self.timeout
         self.loop = loop
+        self.topics = None
+
+        self.max_queue = max_queue
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow = overflow
+        self.overflow_close = overflow_close
+        self.budget = budget
+        self.dispatcher = dispatcher
+        self.batch_messages = batch_messages
+        self.metrics = metrics
+        self.codec = codec
+        self.replay = replay
+        self.sent_seq = 0
+        self.rate_limit = rate_limit
 
         self._hits = 0
         self._heartbeats = 0
         self._heartbeat_transport = False
-        self._debug = debug
+        if tracer is None and debug:
+            tracer = DEBUG_TRACER
+        self.tracer = (
+            tracer if tracer is not None and tracer.sampled(id) else None)
+        # created on first use
         self._waiter = None
-        self._queue = collections.deque()
+        self._queue = None  # normal priority messages
+        self._control = None  # control frames, sent first
+        self._urgent = None  # high priority messages, sent next
+        self._queued = 0
+        self._queued_bytes = 0
+        self._keys = None  # conflation key -> queued message
+        self._replay = None  # ring of (seq, frame, data) sent lately
+        self._buckets = None  # rate limit token buckets
+        self._wheel = None  # ``ExpiryWheel`` of the manager
+        self._bucket = None  # index of the wheel bucket
 
     def __str__(self):
         result = ["id=%r" % (self.id,)]
@@ -56,8 +242,9 @@ class Session(object):
         if self.acquired:
             result.append("acquired")
 
-        if len(self._queue):
-            result.append("queue[%s]" % len(self._queue))
+        pending = self._pending()
+        if pending:
+            result.append("queue[%s]" % pending)
         if self._hits:
             result.append("hits=%s" % self._hits)
         if self._heartbeats:
@@ -67,9 +254,12 @@ class Session(object):
 
     def _tick(self, timeout=None):
         if timeout is None:
-            self.expires = datetime.now() + self.timeout
+            self.expires = self.loop.time() + self.timeout
         else:
-            self.expires = datetime.now() + timeout
+            self.expires = self.loop.time() + _seconds(timeout)
+
+        if self._wheel is not None:
+            self._wheel.schedule(self)
 
     async def _acquire(self, manager, heartbeat=True):
         self.acquired = True
@@ -79,12 +269,16 @@ class Session(object):
         self._tick()
         self._hits += 1
 
+        if self.tracer is not None:
+            self.tracer.emit(TRACE_ACQUIRE, self)
+
         if self.state == STATE_NEW:
-            log.debug("open session: %s", self.id)
+            if self.tracer is not None:
+                self.tracer.emit(TRACE_OPEN, self)
             self.state = STATE_OPEN
             self._feed(FRAME_OPEN, FRAME_OPEN)
             try:
-                await self.handler(OpenMessage, self)
+                await self._call_handler(OpenMessage)
             except asyncio.CancelledError:
                 raise
             except Exception as exc:
@@ -95,24 +289,144 @@ class Session(object):
                 log.exception("Exception in open session handling.")
 
     def _release(self):
+        if self.tracer is not None:
+            self.tracer.emit(TRACE_RELEASE, self)
         self.acquired = False
         self.manager = None
         self._heartbeat_transport = False
 
     def _heartbeat(self):
         self._heartbeats += 1
-        if self._heartbeat:
+        if self._heartbeat_transport:
             self._feed(FRAME_HEARTBEAT, FRAME_HEARTBEAT)
 
-    def _feed(self, frame, data):
-        # pack messages
-        if frame == FRAME_MESSAGE:
-            if self._queue and self._queue[-1][0] == FRAME_MESSAGE:
-                self._queue[-1][1].append(data)
-            else:
-                self._queue.append((frame, [data]))
+    def _overflows(self, size):
+        budget = self.budget
+        return (
+            (self.max_queue and self._queued >= self.max_queue) or
+            (self.max_queue_bytes and
+             self._queued_bytes + size > self.max_queue_bytes) or
+            (budget is not None and budget.max_bytes and
+             budget.bytes + size > budget.max_bytes))
+
+    def _account(self, count, size):
+        self._queued += count
+        self._queued_bytes += size
+        if self.budget is not None:
+            self.budget.messages += count
+            self.budget.bytes += size
+
+    def _pending(self):
+        return (len(self._control or ()) + len(self._urgent or ()) +
+                len(self._queue or ()))
+
+    def _queue_message(self, frame, data, key=None,
+                       priority=PRIORITY_NORMAL):
+        size = _size(data)
+
+        if key is not None and self._keys and key in self._keys:
+            # conflate: replace the message that is still queued
+            item = self._keys[key]
+            self._account(0, size - _size(item[1]))
+            item[0] = frame
+            item[1] = data
+            return True
+
+        if self._overflows(size):
+            policy = self.overflow
+            if self.budget is not None:
+                self.budget.overflows[policy] += 1
+
+            if policy == OVERFLOW_DROP_OLDEST:
+                while self._queued and self._overflows(size):
+                    self._drop_oldest()
+            elif policy == OVERFLOW_CONFLATE:
+                self._conflate(size)
+            elif policy == OVERFLOW_CLOSE:
+                self._drop_messages()
+                self.close(*self.overflow_close)
+                return False
+
+            if policy == OVERFLOW_DROP_NEWEST or self._overflows(size):
+                return False
+
+        if priority == PRIORITY_HIGH:
+            if self._urgent is None:
+                self._urgent = collections.deque()
+            queue = self._urgent
+        else:
+            if self._queue is None:
+                self._queue = collections.deque()
+            queue = self._queue
+
+        if key is None:
+            queue.append((frame, data))
+        else:
+            if self._keys is None:
+                self._keys = {}
+            item = [frame, data, key]
+            self._keys[key] = item
+            queue.append(item)
+
+        self._account(1, size)
+        return True
+
+    def _dequeued(self, items):
+        size = 0
+        for item in items:
+            size += _size(item[1])
+            if len(item) > 2:
+                del self._keys[item[2]]
+
+        self._account(-len(items), -size)
+
+    def _drop_oldest(self):
+        # normal priority messages go before high priority ones
+        queue = self._queue or self._urgent
+        if queue:
+            self._dequeued((queue.popleft(),))
+
+    def _conflate(self, size):
+        """Make room in the normal priority queue for ``size`` bytes.
+
+        Messages sent without a key go first, then the oldest keyed ones; a
+        queued keyed message is the latest of its key already. High
+        priority messages are kept.
+        """
+        queue = self._queue
+        if not queue:
+            return
+
+        unkeyed = [item for item in queue if len(item) < 3]
+        if unkeyed:
+            self._dequeued(unkeyed)
+            keyed = [item for item in queue if len(item) > 2]
+            queue.clear()
+            queue.extend(keyed)
+
+        while queue and self._overflows(size):
+            self._dequeued((queue.popleft(),))
+
+    def _drop_messages(self):
+        """Drop all queued messages, keep control frames."""
+        if not self._queued:
+            return
+
+        for queue in (self._queue, self._urgent):
+            if queue:
+                self._dequeued(queue)
+                queue.clear()
+
+    def _feed(self, frame, data, key=None, priority=PRIORITY_NORMAL):
+        if frame in DATA_FRAMES:
+            if not self._queue_message(frame, data, key, priority):
+                return
         else:
-            self._queue.append((frame, data))
+            if self._control is None:
+                self._control = collections.deque()
+            elif frame == FRAME_HEARTBEAT and (frame, data) in self._control:
+                return  # still waiting to go out
+            self._control.append((frame, data))
 
         # notify waiter
         waiter = self._waiter
@@ -121,30 +435,114 @@ class Session(object):
             if not waiter.cancelled():
                 waiter.set_result(True)
 
+    def _take(self):
+        if self._control:
+            return self._control.popleft()
+
+        queue = self._urgent or self._queue
+        item = queue.popleft()
+        frame = item[0]
+
+        # pack messages of the same frame type
+        items = [item]
+        while queue and queue[0][0] == frame:
+            items.append(queue.popleft())
+
+        self._dequeued(items)
+        messages = [item[1] for item in items]
+
+        if self.replay:
+            if self._replay is None:
+                self._replay = collections.deque(maxlen=self.replay)
+            seq = self.sent_seq
+            for data in messages:
+                seq += 1
+                self._replay.append((seq, frame, data))
+            self.sent_seq = seq
+        else:
+            self.sent_seq += len(messages)
+
+        return frame, messages
+
+    def _resume(self, last_seq):
+        """Queue again the messages sent after ``last_seq``.
+
+        They keep their sequence numbers. Returns ``False`` when some of them
+        are not in the replay ring any more; without ``replay`` only a client
+        that received every sent message can resume.
+        """
+        if not 0 <= last_seq <= self.sent_seq:
+            return False
+
+        ring = self._replay or ()
+        if last_seq < self.sent_seq and (
+                not ring or ring[0][0] > last_seq + 1):
+            return False
+
+        gap = []
+        while ring and ring[-1][0] > last_seq:
+            gap.append(ring.pop())
+        self.sent_seq = last_seq
+
+        if gap:
+            if self._queue is None:
+                self._queue = collections.deque()
+            for _, frame, data in gap:
+                self._queue.appendleft((frame, data))
+                self._account(1, _size(data))
+        return True
+
     async def _wait(self):
-        if not self._queue and self.state != STATE_CLOSED:
+        """Next frame to send: control frames, then messages by priority."""
+        if not self._pending() and self.state != STATE_CLOSED:
             assert not self._waiter
             self._waiter = asyncio.Future(loop=self.loop)
-            await self._waiter
+            try:
+                await self._waiter
+            finally:
+                # the transport may be gone, let the next one wait
+                self._waiter = None
 
-        if self._queue:
-            frame, payload = self._queue.popleft()
-            return frame, payload
+        if self._pending():
+            return self._take()
         else:
             raise SessionIsClosed()
 
+    def _pop_messages(self):
+        """Pop messages queued right at the head of the queue."""
+        if self._control:
+            return []
+
+        queue = self._urgent or self._queue
+        if queue and queue[0][0] == FRAME_MESSAGE:
+            return self._take()[1]
+        return []
+
+    def _discard(self):
+        """Drop everything queued, the session is gone."""
+        self._drop_messages()
+        self._queue = self._control = self._urgent = None
+
+    async def _call_handler(self, msg):
+        if self.dispatcher is None:
+            await self.handler(msg, self)
+        else:
+            await self.dispatcher.flush(self)
+            await self.dispatcher.call(self, msg)
+
     async def _remote_close(self, exc=None):
         """close session from remote."""
         if self.state in (STATE_CLOSING, STATE_CLOSED):
             return
 
-        log.info("close session: %s", self.id)
+        if self.tracer is not None:
+            self.tracer.emit(TRACE_REMOTE_CLOSE, self, exc)
         self.state = STATE_CLOSING
         if exc is not None:
             self.exception = exc
             self.interrupted = True
         try:
-            await self.handler(SockjsMessage(MSG_CLOSE, exc), self)
+            await self._call_handler(SockjsMessage(MSG_CLOSE, exc))
         except Exception:
             log.exception("Exception in close handler.")
 
@@ -152,11 +550,12 @@ class Session(object):
         if self.state == STATE_CLOSED:
             return
 
-        log.info("session closed: %s", self.id)
+        if self.tracer is not None:
+            self.tracer.emit(TRACE_CLOSED, self)
         self.state = STATE_CLOSED
         self.expire()
         try:
-            await self.handler(ClosedMessage, self)
+            await self._call_handler(ClosedMessage)
         except Exception:
             log.exception("Exception in closed handler.")
 
@@ -167,48 +566,142 @@ class Session(object):
             if not waiter.cancelled():
                 waiter.set_result(True)
 
-    async def _remote_message(self, msg):
-        log.debug("incoming message: %s, %s", self.id, msg[:200])
-        self._tick()
+    async def _deliver(self, msg):
+        if self.dispatcher is not None:
+            await self.dispatcher.dispatch(self, msg)
+            return
 
+        metrics = self.metrics
+        started = self.loop.time()
         try:
-            await self.handler(SockjsMessage(MSG_MESSAGE, msg), self)
+            await self.handler(msg, self)
         except Exception:
+            if metrics is not None:
+                metrics.handler_errors.value += 1
             log.exception("Exception in message handler.")
 
-    async def _remote_messages(self, messages):
-        self._tick()
+        if metrics is not None:
+            metrics.handler_time.observe(self.loop.time() - started)
 
+    def _abort(self):
+        """Mark the session closed without calling the handler."""
+        if self.state == STATE_CLOSED:
+            return
+
+        self.state = STATE_CLOSED
+        self.expire()
+
+        # notify waiter
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            if not waiter.cancelled():
+                waiter.set_result(True)
+
+    def _throttle(self, messages):
+        """Charge incoming messages to the rate limit.
+
+        Returns how long the transport should stop reading for, seconds, or
+        ``None`` when the session got closed for going over the limit and
+        the messages are to be dropped.
+        """
+        limit = self.rate_limit
+        if limit is None:
+            return 0.0
+
+        now = self.loop.time()
+        if self._buckets is None:
+            self._buckets = limit.buckets(now)
+        count, size = self._buckets
+
+        delay = 0.0
+        if count is not None:
+            delay = count.take(len(messages), now)
+        if size is not None:
+            delay = max(delay, size.take(
+                sum(len(msg) for msg in messages), now))
+
+        if not delay:
+            return delay
+
+        if self.metrics is not None:
+            self.metrics.rate_limited.value += 1
+        if limit.action == LIMIT_CLOSE:
+            self.close(*limit.close)
+            return None
+        return delay
+
+    def _decode(self, messages):
+        codec = self.codec
+        decoded = []
         for msg in messages:
-            log.debug("incoming message: %s, %s", self.id, msg[:200])
             try:
-                await self.handler(SockjsMessage(MSG_MESSAGE, msg), self)
+                decoded.append(codec.decode(msg))
             except Exception:
-                log.exception("Exception in message handler.")
+                log.exception("Can not decode message.")
+        return decoded
+
+    async def _remote_messages(self, messages):
+        if self.tracer is not None:
+            self.tracer.emit(TRACE_MESSAGE_IN, self, messages)
+        self._tick()
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.messages_in.value += len(messages)
+            metrics.bytes_in.value += sum(len(msg) for msg in messages)
+
+        if self.codec is not None:
+            messages = self._decode(messages)
+
+        if self.batch_messages and len(messages) > 1:
+            await self._deliver(SockjsMessage(MSG_MESSAGES, messages))
+            return
+
+        for msg in messages:
+            await self._deliver(SockjsMessage(MSG_MESSAGE, msg))
 
     def expire(self):
         """Manually expire a session."""
         self.expired = True
 
-    def send(self, msg):
-        """send message to client."""
-        assert isinstance(msg, str), "String is required"
+    def send(self, msg, key=None, priority=PRIORITY_NORMAL):
+        """send message to client.
+
+        ``msg`` is a string or a ``TextFrame`` encoded once for many sessions,
+        ``bytes``, ``bytearray`` or ``memoryview`` is sent as a binary frame
+        without copying, so it must not be modified afterwards.
+        A message sent with ``key`` replaces the not yet sent message with the
+        same key instead of being queued after it.
+        ``PRIORITY_HIGH`` messages go out ahead of queued normal ones.
+        """
+        if isinstance(msg, (str, TextFrame)):
+            frame = FRAME_MESSAGE
+        else:
+            assert isinstance(msg, (bytes, bytearray, memoryview)), \
+                "String or bytes-like object is required"
+            frame = FRAME_BINARY
 
-        if self._debug:
-            log.info("outgoing message: %s, %s", self.id, str(msg)[:200])
+        if self.tracer is not None:
+            self.tracer.emit(TRACE_MESSAGE_OUT, self, msg)
 
         if self.state != STATE_OPEN:
             return
 
-        self._feed(FRAME_MESSAGE, msg)
+        self._feed(frame, msg, key, priority)
+
+    def send_obj(self, obj, key=None, priority=PRIORITY_NORMAL):
+        """encode object with the session codec and send it to client."""
+        codec = self.codec if self.codec is not None else DEFAULT_CODEC
+        self.send(codec.encode(obj), key, priority)
 
     def close(self, code=3000, reason="Go away!"):
-        """close session"""
+        """close session, ahead of messages still queued"""
         if self.state in (STATE_CLOSING, STATE_CLOSED):
             return
 
-        if self._debug:
-            log.debug("close session: %s", self.id)
+        if self.tracer is not None:
+            self.tracer.emit(TRACE_CLOSE, self, (code, reason))
 
         self.state = STATE_CLOSING
         self._feed(FRAME_CLOSE, (code, reason))
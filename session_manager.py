@@ -1,31 +1,162 @@
+import asyncio
+import collections
+import logging
+import random
 import warnings
 from asyncio import ensure_future
-from datetime import timedelta, datetime
+from datetime import timedelta
 
-from exceptions import SessionIsAcquired
-from protocol import STATE_OPEN, STATE_CLOSING, STATE_CLOSED
-from session import Session
+from codec import DEFAULT_CODEC
+from exceptions import SessionIsAcquired, TooManySessions
+from metrics import SessionMetrics
+from protocol import STATE_NEW, STATE_OPEN, STATE_CLOSING, STATE_CLOSED
+from protocol import OVERFLOW_DROP_OLDEST, CLOSE_RESTART
+from protocol import encode_text
+import handoff
+from session import ExpiryWheel, Session, SendQueueBudget
+from tracing import TRACE_EXPIRE
+
+log = logging.getLogger("sockjs")
 
 _marker = object()
 
+_STATE_NAMES = {
+    STATE_NEW: "new",
+    STATE_OPEN: "open",
+    STATE_CLOSING: "closing",
+    STATE_CLOSED: "closed",
+}
+
+
+class TeardownResult(collections.namedtuple(
+        "TeardownResult",
+        ["total", "closed", "failed", "cancelled", "elapsed"])):
+    """Outcome of closing many sessions at once.
+
+    ``cancelled`` sessions missed the deadline, their handlers were
+    cancelled or never called.
+    """
+
 
 class SessionManager(dict):
-    """A basic session manager."""
+    """A basic session manager.
+
+    ``max_queue``, ``max_queue_bytes``, ``overflow``: per session send queue
+    limits and overflow policy, see ``Session``
+    ``max_queued_bytes``: limit for all send queues together, 0 for no limit
+    ``dispatcher``: ``Dispatcher`` shared by the sessions, handlers are
+    awaited on the receive loop without it
+    ``batch_messages``: handler accepts ``MSG_MESSAGES`` batches, see
+    ``Session``
+    ``metrics``: ``SessionMetrics`` to update, a new one by default; hooks
+    added to it are pushed every heartbeat
+    ``heartbeat_slices``: acquired sessions are split into that many buckets
+    by id, one bucket is pinged every ``heartbeat / heartbeat_slices``
+    seconds so pings are spread over the interval
+    ``expiry_granularity``: width of the expiry buckets, seconds, see
+    ``ExpiryWheel``; keep it below the session timeout
+    ``teardown_concurrency``: sessions closed at once on expiry and
+    ``clear()``
+    ``teardown_timeout``: deadline for closing them, seconds, ``None`` to
+    wait for all handlers
+    ``codec``: default ``codec.Codec`` of new sessions, see ``Session``
+    ``replay``: sent messages kept per session for ``resume``, see
+    ``Session``
+    ``rate_limit``: ``limits.RateLimit`` for incoming messages of each
+    session, see ``Session``
+    ``max_sessions``: new sessions are refused at that many sessions, 0 for
+    no limit
+    ``max_lag``: new sessions are refused while the event loop runs late by
+    more than that, seconds, 0 for no limit
+    ``tracer``: ``tracing.Tracer`` of new sessions, see ``Session``
+    ``presence``: ``presence.Presence`` counting the members of topics that
+    have a transport and reporting joins and leaves, optional
+    ``loop_lag``: how late the last heartbeat timer fired, seconds, measured
+    once started
+    ``draining``: set by ``drain()``, no sessions are accepted any more
+    """
 
     _hb_handle = None  # heartbeat event loop timer
     _hb_task = None  # gc task
 
     def __init__(self, app, handler, loop,
-                 heartbeat=25.0, timeout=timedelta(seconds=5), debug=False):
+                 heartbeat=25.0, timeout=timedelta(seconds=5), debug=False,
+                 max_queue=0, max_queue_bytes=0,
+                 overflow=OVERFLOW_DROP_OLDEST, max_queued_bytes=0,
+                 dispatcher=None, batch_messages=False, metrics=None,
+                 heartbeat_slices=10, teardown_concurrency=100,
+                 teardown_timeout=None, codec=None, replay=0,
+                 rate_limit=None, max_sessions=0, max_lag=0, tracer=None,
+                 presence=None, expiry_granularity=1.0):
         self.app = app
         self.handler = handler
         self.factory = Session
         self.acquired = {}
-        self.sessions = []
+        self.sessions = ExpiryWheel(expiry_granularity)
         self.heartbeat = heartbeat
+        self.heartbeat_slices = heartbeat_slices
         self.timeout = timeout
+        self.teardown_concurrency = teardown_concurrency
+        self.teardown_timeout = teardown_timeout
         self.loop = loop
         self.debug = debug
+        self.topics = {}  # topic -> set of subscribed sessions
+        self.max_queue = max_queue
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow = overflow
+        self.budget = SendQueueBudget(max_queued_bytes)
+        self.dispatcher = dispatcher
+        self.batch_messages = batch_messages
+        self.metrics = metrics if metrics is not None else SessionMetrics()
+        self.codec = codec
+        self.replay = replay
+        self.rate_limit = rate_limit
+        self.max_sessions = max_sessions
+        self.max_lag = max_lag
+        self.tracer = tracer
+        self.presence = presence
+        if presence is not None:
+            presence._bind(self)
+        self.draining = False
+        self.loop_lag = 0.0
+        self._add_gauges(self.metrics)
+
+        # acquired sessions to ping, bucketed by id
+        self._hb_buckets = [set() for _ in range(heartbeat_slices)]
+        self._hb_slice = 0
+        self._hb_due = None  # when the heartbeat timer should fire
+
+    def _add_gauges(self, metrics):
+        metrics.gauge(
+            "sockjs_sessions", self._sessions_by_state,
+            "Sessions by state", label="state")
+        metrics.gauge(
+            "sockjs_acquired_sessions", lambda: len(self.acquired),
+            "Sessions with a transport")
+        metrics.gauge(
+            "sockjs_queued_messages", lambda: self.budget.messages,
+            "Messages in send queues")
+        metrics.gauge(
+            "sockjs_queued_bytes", lambda: self.budget.bytes,
+            "Message bytes in send queues")
+        metrics.gauge(
+            "sockjs_loop_lag_seconds", lambda: self.loop_lag,
+            "How late the heartbeat timer fired")
+
+    def _sessions_by_state(self):
+        counts = dict.fromkeys(_STATE_NAMES.values(), 0)
+        for session in self.values():
+            counts[_STATE_NAMES[session.state]] += 1
+        return counts
+
+    @property
+    def overflows(self):
+        """How often each overflow policy triggered."""
+        return self.budget.overflows
+
+    @property
+    def queued_bytes(self):
+        return self.budget.bytes
 
     @property
     def started(self):
@@ -33,8 +164,12 @@ class SessionManager(dict):
 
     def start(self):
         if not self._hb_handle:
-            self._hb_handle = self.loop.call_later(
-                self.heartbeat, self._heartbeat)
+            self._schedule_heartbeat()
+
+    def _schedule_heartbeat(self):
+        delay = self.heartbeat / self.heartbeat_slices
+        self._hb_due = self.loop.time() + delay
+        self._hb_handle = self.loop.call_later(delay, self._heartbeat)
 
     def stop(self):
         if self._hb_handle is not None:
@@ -43,44 +178,132 @@ class SessionManager(dict):
         if self._hb_task is not None:
             self._hb_task.cancel()
             self._hb_task = None
+        if self.presence is not None:
+            self.presence.close()
 
     def _heartbeat(self):
+        self.loop_lag = max(self.loop.time() - self._hb_due, 0.0)
         if self._hb_task is None:
             self._hb_task = ensure_future(
                 self._heartbeat_task(), loop=self.loop)
 
-    async def _heartbeat_task(self):
-        sessions = self.sessions
-
-        if sessions:
-            now = datetime.now()
-
-            idx = 0
-            while idx < len(sessions):
-                session = sessions[idx]
-
-                session._heartbeat()
-
-                if session.expires < now:
-                    # Session is to be GC"d immedietely
-                    if session.id in self.acquired:
-                        await self.release(session)
-
-                    if session.state == STATE_OPEN:
-                        await session._remote_close()
+    def _hb_bucket(self, session):
+        return self._hb_buckets[hash(session.id) % self.heartbeat_slices]
 
-                    if session.state == STATE_CLOSING:
-                        await session._remote_closed()
-
-                    del self[session.id]
-                    del self.sessions[idx]
-                    continue
+    async def _heartbeat_task(self):
+        for session in self._hb_buckets[self._hb_slice]:
+            session._heartbeat()
+        self._hb_slice = (self._hb_slice + 1) % self.heartbeat_slices
 
-                idx += 1
+        await self._expire(self.loop.time())
+        if not self._hb_slice:
+            self.metrics.push()
 
         self._hb_task = None
-        self._hb_handle = self.loop.call_later(
-            self.heartbeat, self._heartbeat)
+        self._schedule_heartbeat()
+
+    def _due(self, now):
+        """Remove sessions whose deadline has passed from the expiry wheel.
+
+        Costs the sessions in the due buckets, however many other sessions
+        were ticked since the last sweep.
+        """
+        return self.sessions.due(now)
+
+    async def _close_expired(self, session):
+        if session.id in self.acquired:
+            await self.release(session)
+
+        if session.state == STATE_OPEN:
+            await session._remote_close()
+
+        if session.state == STATE_CLOSING:
+            await session._remote_closed()
+
+    async def _close_cleared(self, session):
+        if session.state != STATE_CLOSED:
+            await session._remote_closed()
+
+    async def _teardown(self, sessions, close, timeout=None, progress=None):
+        """Close sessions concurrently.
+
+        At most ``teardown_concurrency`` sessions are closed at once; when
+        ``timeout`` passes, running handlers are cancelled and the remaining
+        sessions are closed without calling them. ``progress(done, total)``
+        is called after every session.
+        """
+        total = len(sessions)
+        started = self.loop.time()
+        counts = {"closed": 0, "failed": 0}
+        remaining = iter(sessions)
+
+        async def worker():
+            for session in remaining:
+                try:
+                    await close(session)
+                    counts["closed"] += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    counts["failed"] += 1
+                    log.exception("Exception in session teardown.")
+                finally:
+                    session._abort()
+
+                if progress is not None:
+                    progress(counts["closed"] + counts["failed"], total)
+
+        if total:
+            workers = [
+                ensure_future(worker(), loop=self.loop)
+                for _ in range(min(self.teardown_concurrency or total, total))]
+            _, pending = await asyncio.wait(workers, timeout=timeout)
+
+            if pending:
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+
+                for session in remaining:
+                    session._abort()
+
+        result = TeardownResult(
+            total, counts["closed"], counts["failed"],
+            total - counts["closed"] - counts["failed"],
+            self.loop.time() - started)
+
+        if total:
+            log.info(
+                "closed %d of %d sessions in %.3fs, "
+                "%d failed, %d cancelled",
+                result.closed, total, result.elapsed,
+                result.failed, result.cancelled)
+        return result
+
+    def _remove(self, session):
+        if session.id in self.acquired:
+            session._release()
+            del self.acquired[session.id]
+            self._hb_bucket(session).discard(session)
+            if self.presence is not None:
+                self.presence._released(session)
+
+        self.unsubscribe(session)
+        self.sessions.discard(session)
+        session._discard()
+        del self[session.id]
+
+    async def _expire(self, now):
+        due = self._due(now)
+
+        # Sessions are to be GC"d immedietely
+        await self._teardown(due, self._close_expired, self.teardown_timeout)
+
+        for session in due:
+            if session.tracer is not None:
+                session.tracer.emit(TRACE_EXPIRE, session)
+            self._remove(session)
+        self.metrics.expired.value += len(due)
 
     def _add(self, session):
         if session.expired:
@@ -90,18 +313,70 @@ class SessionManager(dict):
         session.registry = self.app
 
         self[session.id] = session
-        self.sessions.append(session)
+        self.sessions.schedule(session)
         return session
 
+    def _refusal(self):
+        """Why a new session would be refused, ``None`` if it would not."""
+        if self.draining:
+            return "Draining"
+        if self.max_sessions and len(self) >= self.max_sessions:
+            return "Session limit reached"
+        if self.max_lag and self.loop_lag > self.max_lag:
+            return "Event loop lagging"
+        return None
+
+    async def admit(self, timeout=None):
+        """Wait until a new session would be accepted.
+
+        Raises ``TooManySessions`` if it is still refused after ``timeout``
+        seconds, ``None`` waits as long as it takes.
+        """
+        if timeout is not None:
+            deadline = self.loop.time() + timeout
+
+        while True:
+            reason = self._refusal()
+            if reason is None:
+                return
+            if timeout is not None and self.loop.time() >= deadline:
+                self.metrics.refused.value += 1
+                raise TooManySessions(reason)
+            # load changes once per heartbeat slice at the soonest
+            await asyncio.sleep(self.heartbeat / self.heartbeat_slices)
+
+    def _create(self, id):
+        return self.factory(
+            id, self.handler,
+            timeout=self.timeout,
+            loop=self.loop, debug=self.debug,
+            max_queue=self.max_queue,
+            max_queue_bytes=self.max_queue_bytes,
+            overflow=self.overflow,
+            budget=self.budget,
+            dispatcher=self.dispatcher,
+            batch_messages=self.batch_messages,
+            metrics=self.metrics,
+            codec=self.codec,
+            replay=self.replay,
+            rate_limit=self.rate_limit,
+            tracer=self.tracer)
+
     def get(self, id, create=False, default=_marker):
+        """Session by id, a new one with ``create``.
+
+        New sessions are subject to ``max_sessions`` and ``max_lag``, a
+        refused one raises ``TooManySessions``.
+        """
         session = super(SessionManager, self).get(id, None)
         if session is None:
             if create:
-                session = self._add(
-                    self.factory(
-                        id, self.handler,
-                        timeout=self.timeout,
-                        loop=self.loop, debug=self.debug))
+                reason = self._refusal()
+                if reason is not None:
+                    self.metrics.refused.value += 1
+                    raise TooManySessions(reason)
+
+                session = self._add(self._create(id))
             else:
                 if default is not _marker:
                     return default
@@ -109,7 +384,12 @@ class SessionManager(dict):
 
         return session
 
-    async def acquire(self, s):
+    async def acquire(self, s, heartbeat=True):
+        """Bind the session to a transport.
+
+        ``heartbeat``: ping the session, pass ``False`` when the transport
+        pings its connection for all the sessions on it
+        """
         sid = s.id
 
         if sid in self.acquired:
@@ -117,11 +397,30 @@ class SessionManager(dict):
         if sid not in self:
             raise KeyError("Unknown session")
 
-        await s._acquire(self)
+        await s._acquire(self, heartbeat)
 
         self.acquired[sid] = True
+        if heartbeat:
+            self._hb_bucket(s).add(s)
+        if self.presence is not None:
+            self.presence._acquired(s)
         return s
 
+    def resume(self, id, last_seq):
+        """Session to continue after a reconnect, ``None`` if it is gone.
+
+        Messages sent after ``last_seq`` are queued again for the new
+        connection.
+        """
+        session = super(SessionManager, self).get(id, None)
+        if (session is None or session.expired or self.draining or
+                session.state != STATE_OPEN or id in self.acquired):
+            return None
+
+        if not session._resume(last_seq):
+            return None
+        return session
+
     def is_acquired(self, session):
         return session.id in self.acquired
 
@@ -129,25 +428,173 @@ class SessionManager(dict):
         if s.id in self.acquired:
             s._release()
             del self.acquired[s.id]
+            self._hb_bucket(s).discard(s)
+            if self.presence is not None:
+                self.presence._released(s)
 
     def active_sessions(self):
         for session in self.values():
             if not session.expired:
                 yield session
 
-    async def clear(self):
-        """Manually expire all sessions in the pool."""
-        for session in list(self.values()):
-            if session.state != STATE_CLOSED:
-                await session._remote_closed()
+    async def clear(self, timeout=_marker, progress=None):
+        """Manually expire all sessions in the pool.
+
+        Sessions are closed concurrently, ``timeout`` overrides
+        ``teardown_timeout``. Returns a ``TeardownResult``.
+        """
+        if timeout is _marker:
+            timeout = self.teardown_timeout
+
+        sessions = list(self.values())
+        result = await self._teardown(
+            sessions, self._close_cleared, timeout, progress)
+
+        for session in sessions:
+            self._remove(session)
 
         self.sessions.clear()
+        self.topics.clear()
+        if self.presence is not None:
+            self.presence.flush()
+        for bucket in self._hb_buckets:
+            bucket.clear()
         super(SessionManager, self).clear()
-
-    def broadcast(self, message):
+        return result
+
+    async def drain(self, window=10.0, path=None, flush=1.0,
+                    timeout=_marker):
+        """Close all sessions for a restart.
+
+        New sessions are refused. Open sessions are closed with
+        ``CLOSE_RESTART`` and a random reconnect delay up to ``window``
+        seconds as the reason, so clients come back spread over the window.
+        With ``path`` their state is saved there for ``restore`` in the next
+        process, see ``handoff.save``. Transports get up to ``flush`` seconds
+        to write the close frames, ``timeout`` is passed to ``clear``,
+        returns its ``TeardownResult``.
+
+        Clients resume with their session id and the number of messages
+        they received. Sessions send their id only with ``replay``, and
+        without it a client resumes only if it received everything sent.
+        """
+        self.draining = True
+
+        sessions = [session for session in self.values()
+                    if session.state == STATE_OPEN and not session.expired]
+        for session in sessions:
+            session.close(
+                CLOSE_RESTART, "%d" % (random.uniform(0, window) * 1000))
+
+        if path is not None:
+            # closed sessions take no more messages and transports send the
+            # close frame before anything queued, the state stays as saved
+            states = [handoff.dump_session(session) for session in sessions]
+            await handoff.save(path, states)
+            log.info("handed off %d sessions to %s", len(sessions), path)
+
+        deadline = self.loop.time() + flush
+        while self.loop.time() < deadline and any(
+                session.acquired and session._control
+                for session in sessions):
+            await asyncio.sleep(0.05)
+
+        return await self.clear(timeout)
+
+    async def restore(self, path, timeout=None, wait=None):
+        """Restore sessions saved by ``drain`` of the previous process.
+
+        Clients get ``timeout`` seconds to ``resume`` them, their session
+        timeout by default. ``wait`` limits how long to listen for the old
+        process when ``path`` is not a file yet. Returns the sessions.
+        """
+        states = await handoff.load(path, self.loop, wait)
+        sessions = [handoff.restore_session(self, state, timeout)
+                    for state in states
+                    if super(SessionManager, self).get(state["id"]) is None]
+        log.info("restored %d sessions from %s", len(sessions), path)
+        return sessions
+
+    def broadcast(self, message, key=None):
+        """Send message to all sessions, see ``Session.send`` for ``key``."""
+        message = encode_text(message)
         for session in self.values():
             if not session.expired:
-                session.send(message)
+                session.send(message, key)
+
+    def _send_obj(self, sessions, obj, key):
+        # encode once per codec
+        frames = {}
+        for session in sessions:
+            if session.expired:
+                continue
+
+            codec = session.codec if session.codec is not None \
+                else DEFAULT_CODEC
+            frame = frames.get(codec)
+            if frame is None:
+                frame = frames[codec] = codec.encode_frame(obj)
+            session.send(frame, key)
+
+    def broadcast_obj(self, obj, key=None):
+        """Encode object once per codec and send it to all sessions."""
+        self._send_obj(self.values(), obj, key)
+
+    def subscribe(self, session, topic):
+        subscribers = self.topics.setdefault(topic, set())
+        if session in subscribers:
+            return
+
+        subscribers.add(session)
+        if session.topics is None:
+            session.topics = set()
+        session.topics.add(topic)
+
+        if self.presence is not None:
+            self.presence._joined(
+                session, topic, session.id in self.acquired)
+
+    def unsubscribe(self, session, topic=None):
+        """Unsubscribe session from topic, or from all topics."""
+        if not session.topics:
+            return
+
+        topics = list(session.topics) if topic is None else [topic]
+
+        for topic in topics:
+            session.topics.discard(topic)
+
+            subscribers = self.topics.get(topic)
+            if subscribers is None or session not in subscribers:
+                continue
+
+            subscribers.remove(session)
+            if not subscribers:
+                del self.topics[topic]
+
+            if self.presence is not None:
+                self.presence._left(
+                    session, topic, session.id in self.acquired)
+
+    def publish_obj(self, topic, obj, key=None):
+        """Encode object once per codec and send it to topic subscribers."""
+        subscribers = self.topics.get(topic)
+        if subscribers:
+            self._send_obj(subscribers, obj, key)
+
+    def subscribers(self, topic):
+        return self.topics.get(topic, ())
+
+    def publish(self, topic, message, key=None):
+        """Send message to topic subscribers, encoding it only once."""
+        subscribers = self.topics.get(topic)
+        if not subscribers:
+            return
+
+        message = encode_text(message)
+        for session in subscribers:
+            if not session.expired:
+                session.send(message, key)
 
     def __del__(self):
         if len(self.sessions):
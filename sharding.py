@@ -0,0 +1,366 @@
+"""Multi-process sharding of SessionManager.
+
+Every worker process owns the sessions it accepted. Workers share the
+listening port with ``SO_REUSEPORT`` and relay broadcasts, publishes and
+direct sends to each other over a local bus of Unix domain sockets::
+
+    def worker(shard, shards):
+        app = aiohttp.web.Application()
+        manager = ShardedSessionManager(
+            app, handler, app.loop, shard, shards, "/tmp/sockjs-bus")
+        app.on_startup.append(lambda app: manager.start_bus())
+        app.on_cleanup.append(lambda app: manager.stop_bus())
+        aiohttp.web.run_app(app, sock=reuseport_socket("0.0.0.0", 8080))
+
+    run_shards(worker, 4)
+"""
+import asyncio
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import struct
+import uuid
+from asyncio import ensure_future
+
+from client_pool import Backoff
+from metrics import Counter
+from protocol import ENCODING, TextFrame
+from session_manager import SessionManager
+
+log = logging.getLogger("sockjs")
+
+BUS_BROADCAST = "b"
+BUS_PUBLISH = "p"
+BUS_SEND = "s"
+BUS_BROADCAST_OBJ = "B"
+BUS_PUBLISH_OBJ = "P"
+
+_HEADER = struct.Struct("!I")
+
+
+def _dump(message):
+    """Message as JSON, binary ones base64 encoded in a dict."""
+    if isinstance(message, TextFrame):
+        return message.decode(ENCODING)
+    if isinstance(message, str):
+        return message
+    return {"binary": base64.b64encode(message).decode("ascii")}
+
+
+def _load(message):
+    if isinstance(message, dict):
+        return base64.b64decode(message["binary"])
+    return message
+
+
+class ShardBus(object):
+    """ Local bus between the shards of one host
+    ``path``: Directory holding the Unix domain sockets
+    ``shard``: Index of this shard
+    ``shards``: Number of shards
+    ``max_buffer``: Bytes queued for one peer, while it is slow to read or
+    not connected, before frames to it are dropped
+    ``backoff``: ``Backoff`` between attempts to reconnect a lost peer
+    ``dropped``: ``Counter`` of the dropped frames
+
+    Every shard listens on its own socket and keeps one connection to each
+    peer. Messages are length prefixed JSON.
+    """
+
+    def __init__(self, path, shard, shards, loop=None,
+                 max_buffer=4 * 1024 * 1024, backoff=None, dropped=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        self.path = path
+        self.shard = shard
+        self.shards = shards
+        self.loop = loop
+        self.max_buffer = max_buffer
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.dropped = dropped if dropped is not None else Counter(
+            "sockjs_bus_dropped_total", "Bus frames dropped")
+        self.handler = None
+
+        self._server = None
+        self._closing = False
+        self._peers = {}  # shard -> writer
+        self._pending = {}  # shard -> frames sent while not connected
+        self._watchers = {}  # shard -> task waiting for the peer to go away
+        self._accepted = set()  # writers of connections from peers
+
+    def address(self, shard):
+        return os.path.join(self.path, "shard-%d.sock" % shard)
+
+    async def start(self, handler, timeout=10.0):
+        """Listen for peers and connect to all of them."""
+        self.handler = handler
+        self._closing = False
+
+        os.makedirs(self.path, exist_ok=True)
+        address = self.address(self.shard)
+        if os.path.exists(address):
+            os.unlink(address)
+        self._server = await asyncio.start_unix_server(self._serve, address)
+
+        await asyncio.gather(*(
+            self._connect(shard, timeout)
+            for shard in range(self.shards) if shard != self.shard))
+
+    async def stop(self):
+        self._closing = True
+        for task in self._watchers.values():
+            task.cancel()
+        self._watchers.clear()
+
+        for writer in self._peers.values():
+            writer.close()
+        self._peers.clear()
+        self._pending.clear()
+
+        # peers notice the shard is gone
+        for writer in self._accepted:
+            writer.close()
+        self._accepted.clear()
+
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+            address = self.address(self.shard)
+            if os.path.exists(address):
+                os.unlink(address)
+
+    async def _connect(self, shard, timeout):
+        deadline = self.loop.time() + timeout
+
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.address(shard))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self.loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+        self._connected(shard, reader, writer)
+
+    def _connected(self, shard, reader, writer):
+        pending = self._pending.pop(shard, None)
+        if pending:
+            writer.write(pending)
+        self._peers[shard] = writer
+        self._watchers[shard] = ensure_future(
+            self._watch(shard, reader), loop=self.loop)
+
+    async def _watch(self, shard, reader):
+        """Reconnect to the peer once it closes the connection."""
+        try:
+            # peers never write on connections they accepted
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+
+        writer = self._peers.pop(shard, None)
+        if writer is not None:
+            writer.close()
+        if self._closing:
+            return
+
+        log.warning("Lost shard %d, reconnecting.", shard)
+        attempt = 0
+        while not self._closing:
+            await asyncio.sleep(self.backoff.delay(attempt))
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.address(shard))
+            except (FileNotFoundError, ConnectionRefusedError):
+                attempt += 1
+                continue
+
+            log.info("Reconnected to shard %d.", shard)
+            self._connected(shard, reader, writer)
+            return
+
+    async def _serve(self, reader, writer):
+        self._accepted.add(writer)
+        try:
+            while True:
+                size, = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                data = await reader.readexactly(size)
+
+                try:
+                    self.handler(json.loads(data.decode(ENCODING)))
+                except Exception:
+                    log.exception("Exception in shard bus handler.")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._accepted.discard(writer)
+            writer.close()
+
+    def _write(self, shard, frame):
+        writer = self._peers.get(shard)
+        if writer is None or writer.transport.is_closing():
+            # kept for the reconnect, whole frames only
+            pending = self._pending.setdefault(shard, bytearray())
+            if len(pending) + len(frame) > self.max_buffer:
+                self.dropped.inc()
+            else:
+                pending += frame
+        elif (writer.transport.get_write_buffer_size() + len(frame) >
+              self.max_buffer):
+            self.dropped.inc()
+        else:
+            writer.write(frame)
+
+    def send(self, shard, message):
+        data = json.dumps(message).encode(ENCODING)
+        self._write(shard, _HEADER.pack(len(data)) + data)
+
+    def send_all(self, message):
+        data = json.dumps(message).encode(ENCODING)
+        frame = _HEADER.pack(len(data)) + data
+
+        for shard in range(self.shards):
+            if shard != self.shard:
+                self._write(shard, frame)
+
+    async def drain(self):
+        """Wait for the peers to read what was written to them."""
+        for writer in list(self._peers.values()):
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass  # reconnected by the watcher
+
+
+class ShardedSessionManager(SessionManager):
+    """Session manager owning one shard of the sessions of a host.
+
+    Session ids created with ``new_id`` carry the shard index so direct sends
+    go straight to the owning shard, other ids are offered to every shard.
+    """
+
+    def __init__(self, app, handler, loop, shard, shards, path, **kwargs):
+        super(ShardedSessionManager, self).__init__(
+            app, handler, loop, **kwargs)
+
+        self.shard = shard
+        self.shards = shards
+        self.bus = ShardBus(
+            path, shard, shards, loop, dropped=self.metrics.counter(
+                "sockjs_bus_dropped_total",
+                "Bus frames dropped for a slow or unreachable shard"))
+
+    async def start_bus(self, timeout=10.0):
+        await self.bus.start(self._bus_message, timeout)
+
+    async def stop_bus(self):
+        await self.bus.stop()
+
+    def new_id(self):
+        return "%d.%s" % (self.shard, uuid.uuid4().hex)
+
+    def shard_of(self, id):
+        shard, sep, _ = id.partition(".")
+        if sep and shard.isdigit() and int(shard) < self.shards:
+            return int(shard)
+        return None
+
+    def _bus_message(self, message):
+        cmd = message[0]
+
+        if cmd == BUS_BROADCAST:
+            _, data, key = message
+            super(ShardedSessionManager, self).broadcast(_load(data), key)
+        elif cmd == BUS_PUBLISH:
+            _, topic, data, key = message
+            super(ShardedSessionManager, self).publish(
+                topic, _load(data), key)
+        elif cmd == BUS_SEND:
+            _, id, data, key = message
+            self._send_local(id, _load(data), key)
+        elif cmd == BUS_BROADCAST_OBJ:
+            _, obj, key = message
+            super(ShardedSessionManager, self).broadcast_obj(obj, key)
+        elif cmd == BUS_PUBLISH_OBJ:
+            _, topic, obj, key = message
+            super(ShardedSessionManager, self).publish_obj(topic, obj, key)
+
+    def _send_local(self, id, message, key=None):
+        session = self.get(id, default=None)
+        if session is None or session.expired:
+            return False
+
+        session.send(message, key)
+        return True
+
+    def broadcast(self, message, key=None):
+        super(ShardedSessionManager, self).broadcast(message, key)
+        self.bus.send_all([BUS_BROADCAST, _dump(message), key])
+
+    def publish(self, topic, message, key=None):
+        super(ShardedSessionManager, self).publish(topic, message, key)
+        self.bus.send_all([BUS_PUBLISH, topic, _dump(message), key])
+
+    def broadcast_obj(self, obj, key=None):
+        """Encode object once per codec on every shard and send it to all
+        sessions.
+
+        The object crosses the bus as JSON, so it must be JSON serializable;
+        it is put on the bus first, an object that is not fails before
+        anything is sent.
+        """
+        self.bus.send_all([BUS_BROADCAST_OBJ, obj, key])
+        super(ShardedSessionManager, self).broadcast_obj(obj, key)
+
+    def publish_obj(self, topic, obj, key=None):
+        """Encode object once per codec on every shard and send it to topic
+        subscribers, see ``broadcast_obj``."""
+        self.bus.send_all([BUS_PUBLISH_OBJ, topic, obj, key])
+        super(ShardedSessionManager, self).publish_obj(topic, obj, key)
+
+    def send(self, id, message, key=None):
+        """Send message to a session owned by any shard."""
+        if self._send_local(id, message, key):
+            return
+
+        shard = self.shard_of(id)
+        if shard is None:
+            self.bus.send_all([BUS_SEND, id, _dump(message), key])
+        elif shard != self.shard:
+            self.bus.send(shard, [BUS_SEND, id, _dump(message), key])
+
+
+def reuseport_socket(host, port):
+    """Listening socket that several processes can bind together."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_shards(target, shards, *args):
+    """Run ``target(shard, shards, *args)`` in a process per shard."""
+    processes = [
+        multiprocessing.Process(
+            target=target, args=(shard, shards) + args, daemon=True)
+        for shard in range(shards)]
+
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
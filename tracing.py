@@ -0,0 +1,68 @@
+"""Session tracing hooks.
+
+Sessions keep a ``Tracer`` only when they are sampled, every hook site is
+a single ``None`` check for the others. Subscribers are called as
+``fn(event, session, data)`` with one of the ``TRACE_*`` events:
+
+``TRACE_OPEN``: first transport acquired the session
+``TRACE_ACQUIRE``, ``TRACE_RELEASE``: transport bound and unbound
+``TRACE_MESSAGE_IN``: list of messages received together
+``TRACE_MESSAGE_OUT``: message queued by ``Session.send``
+``TRACE_CLOSE``: ``(code, reason)`` of a close from this side
+``TRACE_REMOTE_CLOSE``: exception that closed the connection or ``None``
+``TRACE_CLOSED``: session is closed
+``TRACE_EXPIRE``: session timed out
+"""
+import logging
+import zlib
+
+log = logging.getLogger("sockjs")
+
+TRACE_OPEN = 'open'
+TRACE_ACQUIRE = 'acquire'
+TRACE_RELEASE = 'release'
+TRACE_MESSAGE_IN = 'message_in'
+TRACE_MESSAGE_OUT = 'message_out'
+TRACE_CLOSE = 'close'
+TRACE_REMOTE_CLOSE = 'remote_close'
+TRACE_CLOSED = 'closed'
+TRACE_EXPIRE = 'expire'
+
+
+class Tracer(object):
+    """ Session event hooks
+    ``sample``: share of sessions traced, 0.001 traces one in a thousand;
+    the choice depends on the session id only, so all processes agree
+    ``subscribers``: callables getting the events
+    """
+
+    def __init__(self, sample=1.0, subscribers=()):
+        self.sample = sample
+        self.subscribers = list(subscribers)
+
+    def subscribe(self, fn):
+        self.subscribers.append(fn)
+
+    def unsubscribe(self, fn):
+        self.subscribers.remove(fn)
+
+    def sampled(self, id):
+        """Whether the session with that id is traced."""
+        if self.sample >= 1.0:
+            return True
+        return zlib.crc32(str(id).encode("utf-8")) < self.sample * 0x100000000
+
+    def emit(self, event, session, data=None):
+        for fn in self.subscribers:
+            try:
+                fn(event, session, data)
+            except Exception:
+                log.exception("Exception in trace subscriber.")
+
+
+def log_subscriber(event, session, data):
+    """Session events as debug log records."""
+    log.debug("%s: %s, %.200r", event, session.id, data)
+
+
+DEBUG_TRACER = Tracer(subscribers=(log_subscriber,))
@@ -1,9 +1,15 @@
 import asyncio
+import logging
 from asyncio import ensure_future
 
 from aiohttp import web
 
+from compression import OPCODE_TEXT, OPCODE_BINARY, PING_FRAME
+from compression import deflated_frame, frame_header, shared_profile
 from exceptions import SessionIsClosed
+from protocol import TextFrame, encode_batch, decode_batch
+
+log = logging.getLogger("sockjs")
 
 CMD_OPEN = 1
 CMD_CLOSE = 2
@@ -11,11 +17,46 @@ CMD_CLOSED = 3
 CMD_CLOSING = 4
 CMD_MESSAGE = 5
 CMD_HEARTBEAT = 6
+CMD_BINARY = 7
+
+
+async def _write_frame(ws, frame):
+    writer = ws._writer
+    writer.transport.write(frame)
+
+    writer._output_size += len(frame)
+    if writer._output_size > writer._limit:
+        writer._output_size = 0
+        await writer.protocol._drain_helper()
+
+
+async def _send_text(ws, data, wbits=None):
+    if isinstance(data, TextFrame):
+        if wbits is not None:
+            # compressed once for all connections with this window size
+            await _write_frame(ws, deflated_frame(data, wbits))
+        else:
+            # already encoded, skip the per call encoding of send_str
+            await ws._writer.send(data, binary=False)
+    else:
+        await ws.send_str(data)
+
+
+def _batches(messages, size):
+    for idx in range(0, len(messages), size):
+        yield encode_batch(messages[idx:idx + size])
 
 
 class BasicTransport:
-    def __init__(self, loop=None):
+    """Transport base.
+
+    ``batch_size``: send up to that many queued messages as one batch frame,
+    0 disables batching
+    """
+
+    def __init__(self, loop=None, batch_size=0):
         self.loop = loop
+        self.batch_size = batch_size
 
     async def _await_cmd(self):
         raise NotImplementedError
@@ -35,6 +76,9 @@ class BasicTransport:
     async def _send(self, data):
         raise NotImplementedError
 
+    async def _send_binary(self, data):
+        raise NotImplementedError
+
     async def _receive(self):
         raise NotImplementedError
 
@@ -55,9 +99,16 @@ class BasicTransport:
                 break
 
             if frame == CMD_MESSAGE:
+                if self.batch_size:
+                    cmd_data = _batches(cmd_data, self.batch_size)
+
                 for data in cmd_data:
                     await self._send(data)
 
+            elif frame == CMD_BINARY:
+                for data in cmd_data:
+                    await self._send_binary(data)
+
             elif frame == CMD_HEARTBEAT:
                 await self._ping()
 
@@ -110,57 +161,244 @@ class BasicTransport:
 
 
 class WSBasicTransport(BasicTransport):
-    def __init__(self, ws, loop=None):
-        super().__init__(loop)
+    def __init__(self, ws, loop=None, batch_size=0):
+        super().__init__(loop, batch_size)
         self.ws = ws
 
     async def _ping(self):
         await self.ws.ping()
 
     async def _send(self, data):
-        await self.ws.send_str(data)
+        await _send_text(self.ws, data)
+
+    async def _send_binary(self, data):
+        await self.ws.send_bytes(data)
 
 
 class WebSocketTransport_HLEB:
-    def __init__(self, session, loop):
+    """WebSocket transport bound to a single session.
+
+    ``batch_size``: send up to that many queued messages as one batch frame
+    and expect batch frames from the remote side, 0 disables batching
+    ``batch_age``: how long to hold a batch open for more messages, seconds
+    ``receive_batch``: how many buffered incoming messages to hand to the
+    session in one call
+    ``received``: Messages received, the sequence number to resume from
+    ``cork``: write all frames queued at a wakeup at once, on server side
+    connections that compress nothing or share compressed frames; batches
+    are not held open for ``batch_age`` then
+    ``high_water``: socket buffer size, bytes, above which corked writes
+    wait for the client to catch up
+    ``keep_session``: the session outlives the connection, for clients that
+    reconnect
+    ``close_message``: ``(code, reason)`` the remote side closed with
+    """
+
+    def __init__(self, session, loop, batch_size=0, batch_age=0,
+                 receive_batch=64, cork=True, high_water=64 * 1024,
+                 keep_session=False):
         self.session = session
         self.loop = loop
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.receive_batch = receive_batch
+        self.wbits = None  # window size of shared compressed frames
+        self.received = 0
+        self.cork = cork
+        self.high_water = high_water
+        self.keep_session = keep_session
+        self.close_message = None
+
+    async def _send_messages(self, ws, messages):
+        """Send messages, return the number of frames written."""
+        if not self.batch_size:
+            for text in messages:
+                await _send_text(ws, text, self.wbits)
+            return len(messages)
+
+        if self.batch_age and len(messages) < self.batch_size:
+            await asyncio.sleep(self.batch_age)
+            messages.extend(self.session._pop_messages())
+
+        frames = 0
+        for text in _batches(messages, self.batch_size):
+            await ws.send_str(text)
+            frames += 1
+        return frames
+
+    def _sent(self, messages, frames, started):
+        metrics = self.session.metrics
+        if metrics is not None:
+            metrics.sent(
+                len(messages), frames, sum(len(msg) for msg in messages),
+                self.loop.time() - started)
+
+    def _corkable(self, ws):
+        writer = ws._writer
+        return (self.cork and not self.batch_age and writer is not None and
+                not writer.use_mask and
+                (not ws.compress or self.wbits is not None))
+
+    def _add_frame(self, chunks, payload, opcode):
+        if self.wbits is not None:
+            chunks.append(deflated_frame(payload, self.wbits, opcode))
+        else:
+            chunks.append(frame_header(len(payload), opcode))
+            chunks.append(payload)
+
+    async def _send_corked(self, ws, frame, data):
+        """Write the frame and all frames queued behind it at once.
+
+        Waits for the socket only when its buffer is over ``high_water``.
+        """
+        session = self.session
+        chunks = []
+        messages = []
+        frames = 0
+        close = None
+        started = self.loop.time()
+
+        while True:
+            if frame == CMD_MESSAGE:
+                texts = data
+                if self.batch_size:
+                    texts = _batches(data, self.batch_size)
+                for text in texts:
+                    if isinstance(text, str):
+                        text = text.encode("utf-8")
+                    self._add_frame(chunks, text, OPCODE_TEXT)
+                    frames += 1
+                messages.extend(data)
+
+            elif frame == CMD_BINARY:
+                for payload in data:
+                    self._add_frame(chunks, payload, OPCODE_BINARY)
+                frames += len(data)
+                messages.extend(data)
+
+            elif frame == CMD_HEARTBEAT:
+                chunks.append(PING_FRAME)
+
+            elif frame == CMD_CLOSE:
+                close = data
+                break
+
+            if not session._pending():
+                break
+            frame, data = session._take()
+
+        if chunks:
+            writer = ws._writer
+            transport = writer.transport
+            if transport is None or transport.is_closing():
+                raise ConnectionResetError("Cannot write to closing transport")
+
+            transport.writelines(chunks)
+            if messages:
+                self._sent(messages, frames, started)
+            if transport.get_write_buffer_size() > self.high_water:
+                await writer.protocol._drain_helper()
+
+        if close is not None:
+            code, reason = close
+            try:
+                await ws.close(code=code, message=reason)
+            finally:
+                await session._remote_closed()
 
     async def server(self, ws):
+        corked = self._corkable(ws)
+        if corked:
+            # the protocol pauses writing at the same mark
+            ws._writer.transport.set_write_buffer_limits(high=self.high_water)
+
         while True:
             try:
                 frame, data = await self.session._wait()
             except SessionIsClosed:
                 break
 
-            if frame == CMD_MESSAGE:
-                for text in data:
-                    await ws.send_str(text)
+            if corked:
+                await self._send_corked(ws, frame, data)
+
+            elif frame == CMD_MESSAGE:
+                started = self.loop.time()
+                frames = await self._send_messages(ws, data)
+                self._sent(data, frames, started)
+
+            elif frame == CMD_BINARY:
+                started = self.loop.time()
+                for payload in data:
+                    await ws.send_bytes(payload)
+                self._sent(data, len(data), started)
 
             elif frame == CMD_HEARTBEAT:
                 await ws.ping()
 
             elif frame == CMD_CLOSE:
+                code, reason = data
                 try:
-                    await ws.close(message="Go away!")
+                    await ws.close(code=code, message=reason)
                 finally:
                     await self.session._remote_closed()
 
-    async def client(self, ws):
-        while True:
-            msg = await ws.receive()
+    def _add_message(self, messages, msg):
+        data = msg.data
+        if not data:
+            return
 
-            if msg.type == web.WSMsgType.text:
-                if not msg.data:
-                    continue
+        if msg.type == web.WSMsgType.binary:
+            messages.append(data)
+        elif self.batch_size:
+            try:
+                messages.extend(decode_batch(data))
+            except ValueError:
+                log.warning("Malformed batch frame.")
+        else:
+            messages.append(data)
+
+    async def client(self, ws):
+        pending = None
 
-                await self.session._remote_message(msg.data)
+        while True:
+            if pending is None:
+                msg = await ws.receive()
+            else:
+                msg, pending = pending, None
+
+            if msg.type in (web.WSMsgType.text, web.WSMsgType.binary):
+                messages = []
+                self._add_message(messages, msg)
+
+                # take frames already buffered on the socket along
+                while (len(ws._reader) and
+                       len(messages) < self.receive_batch):
+                    msg = await ws.receive()
+                    if msg.type not in (web.WSMsgType.text,
+                                        web.WSMsgType.binary):
+                        pending = msg
+                        break
+                    self._add_message(messages, msg)
+
+                if messages:
+                    self.received += len(messages)
+                    delay = self.session._throttle(messages)
+                    if delay is not None:
+                        await self.session._remote_messages(messages)
+                    if delay:
+                        # not reading backs the client up on its socket
+                        await asyncio.sleep(delay)
 
             elif msg.type == web.WSMsgType.close:
-                await self.session._remote_close()
+                self.close_message = (msg.data, msg.extra)
+                if not self.keep_session:
+                    await self.session._remote_close()
 
             elif msg.type in (web.WSMsgType.closed, web.WSMsgType.closing):
-                await self.session._remote_closed()
+                if not (self.keep_session or self.session.replay):
+                    await self.session._remote_closed()
+                # a resumable session outlives the connection until it
+                # expires or the remote side reconnects
                 break
 
             elif msg.type == web.WSMsgType.PONG:
@@ -177,23 +415,45 @@ class WebSocketTransport_HLEB:
         except Exception as exc:
             await self.session._remote_close(exc)
         finally:
-            if not server.done():
-                server.cancel()
-
-            if not client.done():
-                client.cancel()
+            for task in (server, client):
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # a write to a dropped connection ends the loop
+                    task.exception()
 
 
 class WebSocketServerHLEB(WebSocketTransport_HLEB):
-    def __init__(self, manager, session, request):
+    """Server side transport.
+
+    ``compress``: offer permessage-deflate, broadcast messages are compressed
+    once for all connections that negotiate no context takeover
+    ``codecs``: ``codec.Codec`` list offered as WebSocket subprotocols, the
+    one the client picks becomes the session codec
+
+    Resumable sessions send their id in the ``X-Session-Id`` header.
+    """
+
+    def __init__(self, manager, session, request, compress=False,
+                 codecs=(), **kwargs):
         self.manager = manager
         self.request = request
+        self.compress = compress
+        self.codecs = {codec.name: codec for codec in codecs}
 
-        super().__init__(session, request.app.loop)
+        super().__init__(session, request.app.loop, **kwargs)
 
     async def process(self):
-        ws = web.WebSocketResponse(autoping=False)
+        ws = web.WebSocketResponse(
+            autoping=False, compress=self.compress,
+            protocols=tuple(self.codecs))
+        if self.session.replay:
+            ws.headers["X-Session-Id"] = self.session.id
         await ws.prepare(self.request)
+        self.wbits = shared_profile(ws)
+
+        if ws.ws_protocol in self.codecs:
+            self.session.codec = self.codecs[ws.ws_protocol]
 
         try:
             await self.manager.acquire(self.session)
@@ -209,12 +469,20 @@ class WebSocketServerHLEB(WebSocketTransport_HLEB):
 
 
 class WebSocketClientHLEB(WebSocketTransport_HLEB):
-    def __init__(self, session, client_session, url):
+    def __init__(self, session, client_session, url, compress=0,
+                 codecs=(), **kwargs):
         self.client_session = client_session
         self.url = url
+        self.compress = compress
+        self.codecs = {codec.name: codec for codec in codecs}
 
-        super().__init__(session, self.client_session.loop)
+        super().__init__(session, self.client_session.loop, **kwargs)
 
     async def process(self):
-        async with self.client_session.ws_connect(self.url) as ws:
+        async with self.client_session.ws_connect(
+                self.url, compress=self.compress,
+                protocols=tuple(self.codecs)) as ws:
+            if ws.protocol in self.codecs:
+                self.session.codec = self.codecs[ws.protocol]
+
             return await super().process(ws)